@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+
+
+def get_equi_data(play_data):
+    extend_data = []
+    for state, mcts_porb, winner in play_data:
+        height, width = state.shape[1:]
+        for i in [1, 2, 3, 4]:
+            equi_state = np.array([np.rot90(s, i) for s in state])
+            equi_mcts_prob = np.rot90(np.flipud(mcts_porb.reshape(height, width)), i)
+            extend_data.append((equi_state, np.flipud(equi_mcts_prob).flatten(), winner))
+            equi_state = np.array([np.fliplr(s) for s in equi_state])
+            equi_mcts_prob = np.fliplr(equi_mcts_prob)
+            extend_data.append((equi_state, np.flipud(equi_mcts_prob).flatten(), winner))
+    return extend_data
+
+
+def random_symmetry(state_batch, mcts_probs_batch):
+    """apply one random rotation/flip of the board to every sample of a
+    minibatch, the lazy counterpart of get_equi_data"""
+    n, _, height, width = state_batch.shape
+    # bring the probabilities into the row order of the state planes
+    probs = mcts_probs_batch.reshape(n, height, width)[:, ::-1, :]
+    transforms = np.random.randint(8, size=n)
+    equi_states = np.empty_like(state_batch)
+    equi_probs = np.empty_like(probs)
+    for t in range(8):
+        idx = np.flatnonzero(transforms == t)
+        if not len(idx):
+            continue
+        states = np.rot90(state_batch[idx], t % 4, axes=(2, 3))
+        t_probs = np.rot90(probs[idx], t % 4, axes=(1, 2))
+        if t >= 4:
+            states = states[:, :, :, ::-1]
+            t_probs = t_probs[:, :, ::-1]
+        equi_states[idx] = states
+        equi_probs[idx] = t_probs
+    return equi_states, equi_probs[:, ::-1, :].reshape(n, height * width)
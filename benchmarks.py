@@ -0,0 +1,481 @@
+# -*- coding: utf-8 -*-
+"""time the engine's hot paths.
+
+    python benchmarks.py run --sizes 8 15 --out bench.json
+    python benchmarks.py run --only board mcts --baseline bench.json
+    python benchmarks.py compare bench.json new.json
+
+Groups: board (do_move, game_end, current_state, and game_end against
+the full-board scan it replaced, after checking that undo restores every
+position), mcts (playouts/sec of
+both MCTS classes with a free uniform policy, so only tree and rollout
+cost is measured), augment (get_equi_data, random_symmetry), net
+(policy_value latency for batch sizes 1-256), numpy_net (the same for
+policy_numpy with best_policy_<size>.model, and the memory of its weights,
+in float32 and int8), train (train_step samples/sec), selfplay
+(games/hour with the network), load (reading best_policy_<size>.model
+pickled or memory-mapped) and startup (seconds from a fresh interpreter
+to the first move, with the full network, an inference-only one and the
+NumPy backend). net, train, selfplay and startup, but for the NumPy
+backend, need Keras and are skipped without it.
+"""
+from __future__ import print_function
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+GROUPS = ('board', 'mcts', 'augment', 'net', 'numpy_net', 'train', 'selfplay', 'load', 'startup')
+REPO = os.path.dirname(os.path.abspath(__file__))
+
+
+def _rate(fn, min_time, count=1):
+    """calls of fn per second, where each call does count operations"""
+    fn()  # warm up
+    n = 0
+    start = time.perf_counter()
+    while True:
+        fn()
+        n += 1
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            return n * count / elapsed
+
+
+def _result(value, unit, higher_is_better=True):
+    return {'value': value, 'unit': unit, 'higher_is_better': higher_is_better}
+
+
+def _random_board(board_class, size, n_moves, seed=0):
+    from config import Conf
+
+    board = board_class(width=size, height=size, n_in_row=Conf.n_in_row, n_history=Conf.n_history)
+    board.init_board()
+    rng = random.Random(seed)
+    for _ in range(n_moves):
+        board.do_move(rng.choice(board.availables))
+        if board.game_end()[0]:
+            board.undo_move()
+            break
+    return board
+
+
+def _full_scan_game_end(board):
+    """game_end as it was before Board tracked the winner in do_move,
+    scanning every stone in four directions on each call"""
+    width = board.width
+    height = board.height
+    states = board.states
+    n = board.n_in_row
+    moved = list(set(range(width * height)) - set(board.availables))
+    if len(moved) >= n * 2 - 1:
+        for m in moved:
+            h = m // width
+            w = m % width
+            player = states[m]
+            if (w in range(width - n + 1) and
+                    len(set(states.get(i, -1) for i in range(m, m + n))) == 1):
+                return True, player
+            if (h in range(height - n + 1) and
+                    len(set(states.get(i, -1) for i in range(m, m + n * width, width))) == 1):
+                return True, player
+            if (w in range(width - n + 1) and h in range(height - n + 1) and
+                    len(set(states.get(i, -1) for i in range(m, m + n * (width + 1), width + 1))) == 1):
+                return True, player
+            if (w in range(n - 1, width) and h in range(height - n + 1) and
+                    len(set(states.get(i, -1) for i in range(m, m + n * (width - 1), width - 1))) == 1):
+                return True, player
+    if not len(board.availables):
+        return True, -1
+    return False, -1
+
+
+def _snapshot(board):
+    return (board.last_move, board.current_player, board.winner, board.zobrist,
+            dict(board.states), sorted(board.availables), sorted(board.sensible_moves()),
+            board.current_state().tobytes())
+
+
+def _check_round_trip(board_class, size, n_games=5):
+    """play random games to the end and undo them one move at a time,
+    every position must come back as it was, with and without history
+    planes and candidate moves"""
+    from config import Conf
+
+    rng = random.Random(2)
+    for n_history, candidate_distance in ((1, 0), (3, 2)):
+        board = board_class(width=size, height=size, n_in_row=Conf.n_in_row,
+                            n_history=n_history, candidate_distance=candidate_distance)
+        for _ in range(n_games):
+            board.init_board(rng.randrange(2))
+            moves = list(range(size * size))
+            rng.shuffle(moves)
+            snapshots = []
+            for move in moves:
+                snapshots.append(_snapshot(board))
+                board.do_move(move)
+            while snapshots:
+                board.undo_move()
+                if _snapshot(board) != snapshots.pop():
+                    raise AssertionError('{}: undo_move did not restore the position with {} moves, '
+                                         'n_history={}'.format(board_class.__name__, len(snapshots), n_history))
+
+
+def bench_board(size, args):
+    from game import Board, ArrayBoard
+
+    results = {}
+    for board_class in (Board, ArrayBoard):
+        name = '{}x{}.{}'.format(size, size, board_class.__name__)
+        _check_round_trip(board_class, size)
+        board = _random_board(board_class, size, 0)
+        rng = random.Random(1)
+        games = []
+        for _ in range(20):
+            moves = list(range(size * size))
+            rng.shuffle(moves)
+            games.append(moves[:size * size // 3])
+
+        def play():
+            for moves in games:
+                for move in moves:
+                    board.do_move(move)
+                board.undo_to(0)
+        n_moves = sum(len(moves) for moves in games)
+        # each move is done and undone once
+        results['board.do_undo.' + name] = _result(_rate(play, args.min_time, n_moves), 'moves/s')
+
+        def rollouts(game_end):
+            """do_move and game_end after every move, as in a rollout"""
+            ends = []
+            for moves in games:
+                for move in moves:
+                    board.do_move(move)
+                    ends.append(game_end(board))
+                    if ends[-1][0]:
+                        break
+                board.undo_to(0)
+            return ends
+        ends = rollouts(board_class.game_end)
+        if rollouts(_full_scan_game_end) != ends:
+            raise AssertionError('{}: game_end disagrees with the full-board scan'.format(name))
+        for suffix, game_end in (('', board_class.game_end), ('_full_scan', _full_scan_game_end)):
+            results['board.rollout{}.{}'.format(suffix, name)] = _result(
+                _rate(lambda: rollouts(game_end), args.min_time, len(ends)), 'moves/s')
+        board = _random_board(board_class, size, size * size // 4)
+        results['board.game_end.' + name] = _result(_rate(board.game_end, args.min_time), 'calls/s')
+        results['board.game_end_full_scan.' + name] = _result(
+            _rate(lambda: _full_scan_game_end(board), args.min_time), 'calls/s')
+        results['board.current_state.' + name] = _result(_rate(board.current_state, args.min_time), 'calls/s')
+    return results
+
+
+def bench_mcts(size, args):
+    from game import ArrayBoard
+    import mcts_alphaZero
+    import mcts_pure
+
+    results = {}
+    board = _random_board(ArrayBoard, size, 4)
+    for array_tree in (False, True):
+        tree = 'array' if array_tree else 'node'
+        mcts_class = mcts_alphaZero.ArrayMCTS if array_tree else mcts_alphaZero.MCTS
+
+        def search():
+            mcts = mcts_class(mcts_pure.policy_value_fn, n_playout=args.playouts)
+            mcts.get_move_probs(board)
+        results['mcts.alphazero_stub.{}x{}.{}'.format(size, size, tree)] = _result(
+            _rate(search, args.min_time, args.playouts), 'playouts/s')
+
+        mcts_class = mcts_pure.ArrayMCTS if array_tree else mcts_pure.MCTS
+
+        def search():
+            mcts = mcts_class(mcts_pure.policy_value_fn, n_playout=args.playouts)
+            mcts.get_move(board)
+        results['mcts.pure.{}x{}.{}'.format(size, size, tree)] = _result(
+            _rate(search, args.min_time, args.playouts), 'playouts/s')
+    engine = mcts_pure.RolloutEngine()
+    results['mcts.rollout.{}x{}'.format(size, size)] = _result(
+        _rate(lambda: engine.run(board), args.min_time), 'rollouts/s')
+    return results
+
+
+def _positions(size, n):
+    from config import Conf
+
+    n_planes = 2 * Conf.n_history + 2
+    states = (np.random.rand(n, n_planes, size, size) > 0.7).astype(np.float32)
+    probs = np.random.dirichlet(np.ones(size * size), size=n).astype(np.float32)
+    winners = np.random.choice([-1.0, 1.0], size=n).astype(np.float32)
+    return states, probs, winners
+
+
+def bench_augment(size, args):
+    from augment import get_equi_data, random_symmetry
+
+    states, probs, winners = _positions(size, 512)
+    play_data = list(zip(states[:64], probs[:64], winners[:64]))
+    return {
+        'augment.get_equi_data.{}x{}'.format(size, size): _result(
+            _rate(lambda: get_equi_data(play_data), args.min_time, len(play_data)), 'positions/s'),
+        'augment.random_symmetry.{}x{}'.format(size, size): _result(
+            _rate(lambda: random_symmetry(states, probs), args.min_time, len(states)), 'positions/s'),
+    }
+
+
+def _network(size):
+    from config import Conf
+
+    Conf.board_width = Conf.board_height = size
+    from policy import PolicyValueNet
+    return PolicyValueNet()
+
+
+def bench_net(size, args):
+    net = _network(size)
+    states, _, _ = _positions(size, max(args.batch_sizes))
+    results = {}
+    for batch_size in args.batch_sizes:
+        batch = states[:batch_size]
+        calls = _rate(lambda: net.policy_value(batch), args.min_time)
+        results['net.policy_value.{}x{}.b{}'.format(size, size, batch_size)] = _result(
+            1000.0 / calls, 'ms', higher_is_better=False)
+    return results
+
+
+def bench_numpy_net(size, args):
+    from config import Conf
+    from policy_numpy import NumpyPolicyValueNet
+
+    Conf.board_width = Conf.board_height = size
+    states, _, _ = _positions(size, max(args.batch_sizes))
+    results = {}
+    for precision in ('float32', 'int8'):
+        net = NumpyPolicyValueNet(_model_file(size), precision)
+        suffix = '' if precision == 'float32' else '.' + precision
+        for batch_size in args.batch_sizes:
+            batch = states[:batch_size]
+            calls = _rate(lambda: net.policy_value(batch), args.min_time)
+            results['numpy_net.policy_value.{}x{}.b{}{}'.format(size, size, batch_size, suffix)] = _result(
+                1000.0 / calls, 'ms', higher_is_better=False)
+        results['numpy_net.weights.{}x{}{}'.format(size, size, suffix)] = _result(
+            sum(net.nbytes()) / 1024.0, 'KB', higher_is_better=False)
+    return results
+
+
+def bench_train(size, args):
+    from config import Conf
+
+    net = _network(size)
+    states, probs, winners = _positions(size, Conf.batch_size)
+    return {'train.train_step.{}x{}'.format(size, size): _result(
+        _rate(lambda: net.train_step(states, probs, winners, Conf.learn_rate), args.min_time, len(states)),
+        'samples/s')}
+
+
+def bench_selfplay(size, args):
+    from config import Conf
+    from game import ArrayBoard, Game
+    from mcts_alphaZero import MCTSPlayer
+
+    net = _network(size)
+    board = ArrayBoard(width=size, height=size, n_in_row=Conf.n_in_row, n_history=Conf.n_history)
+    game = Game(board)
+    player = MCTSPlayer(net.policy_value_fn, c_puct=Conf.c_puct, n_playout=args.playouts, is_selfplay=1)
+    start = time.perf_counter()
+    for _ in range(args.games):
+        game.start_self_play(player, temp=Conf.temp)
+    return {'selfplay.games_per_hour.{}x{}.p{}'.format(size, size, args.playouts): _result(
+        3600.0 * args.games / (time.perf_counter() - start), 'games/h')}
+
+
+def _model_file(size):
+    model_file = os.path.join(REPO, 'best_policy_{}.model'.format(size))
+    if not os.path.exists(model_file):
+        raise ImportError('no {}'.format(os.path.basename(model_file)))
+    return model_file
+
+
+def bench_load(size, args):
+    import pickle
+    from policy import load_params, save_raw_params
+
+    tmp = tempfile.mkdtemp()
+    try:
+        model_file = os.path.join(tmp, 'model.model')
+        shutil.copy(_model_file(size), model_file)
+        pickled = _rate(lambda: pickle.load(open(model_file, 'rb')), args.min_time)
+        save_raw_params(load_params(model_file), model_file)
+        mapped = _rate(lambda: load_params(model_file), args.min_time)
+    finally:
+        shutil.rmtree(tmp)
+    return {
+        'load.pickle.{}x{}'.format(size, size): _result(1000.0 / pickled, 'ms', higher_is_better=False),
+        'load.mmap.{}x{}'.format(size, size): _result(1000.0 / mapped, 'ms', higher_is_better=False),
+    }
+
+
+_STARTUP_SCRIPT = '''
+import sys, time
+start = time.perf_counter()
+sys.path.insert(0, {repo!r})
+from config import Conf
+Conf.board_width = Conf.board_height = {size}
+from game import ArrayBoard
+from mcts_alphaZero import MCTSPlayer
+from policy import PolicyValueNet, inference_net
+imported = time.perf_counter()
+if {backend!r} == 'numpy':
+    Conf.inference_backend = 'numpy'
+    net = inference_net({model_file!r})
+else:
+    net = PolicyValueNet({model_file!r}, inference_only={inference_only})
+loaded = time.perf_counter()
+board = ArrayBoard(width={size}, height={size}, n_in_row=Conf.n_in_row, n_history=Conf.n_history)
+board.init_board()
+MCTSPlayer(net.policy_value_fn, c_puct=Conf.c_puct, n_playout={playouts}).get_action(board)
+print(imported - start, loaded - start, time.perf_counter() - start)
+'''
+
+
+def bench_startup(size, args):
+    """seconds after interpreter start until the modules are imported, the
+    model is loaded and the first move is chosen, in a fresh process"""
+    results = {}
+    errors = []
+    for mode, backend, inference_only in (('full', 'keras', False), ('inference', 'keras', True),
+                                          ('numpy', 'numpy', True)):
+        script = _STARTUP_SCRIPT.format(repo=REPO, size=size, model_file=_model_file(size), backend=backend,
+                                        inference_only=inference_only, playouts=args.playouts)
+        proc = subprocess.run([sys.executable, '-c', script], stdout=subprocess.PIPE,
+                              stderr=subprocess.PIPE, universal_newlines=True)
+        if proc.returncode != 0:
+            error = proc.stderr.strip().splitlines()[-1]
+            print('startup.{} {}x{}: skipped, {}'.format(mode, size, size, error))
+            errors.append(error)
+            continue
+        for name, seconds in zip(('import', 'load', 'first_move'), proc.stdout.split()):
+            results['startup.{}.{}.{}x{}'.format(mode, name, size, size)] = _result(
+                float(seconds), 's', higher_is_better=False)
+    if not results:
+        raise ImportError(errors[0])
+    return results
+
+
+def environment():
+    env = {
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'processor': platform.processor(),
+        'cpu_count': os.cpu_count(),
+    }
+    try:
+        env['git_commit'] = subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        env['git_commit'] = None
+    try:
+        import keras
+        env['keras'] = keras.__version__
+    except ImportError:
+        env['keras'] = None
+    return env
+
+
+def run(args):
+    benches = {'board': bench_board, 'mcts': bench_mcts, 'augment': bench_augment,
+               'net': bench_net, 'numpy_net': bench_numpy_net, 'train': bench_train, 'selfplay': bench_selfplay,
+               'load': bench_load, 'startup': bench_startup}
+    np.random.seed(0)
+    random.seed(0)
+    report = {'environment': environment(), 'args': vars(args).copy(), 'results': {}, 'skipped': {}}
+    report['args'].pop('func', None)
+    for group in args.only:
+        for size in args.sizes:
+            try:
+                results = benches[group](size, args)
+            except ImportError as e:
+                report['skipped']['{}.{}x{}'.format(group, size, size)] = str(e)
+                print('{} {}x{}: skipped, {}'.format(group, size, size, e))
+                continue
+            for name, result in sorted(results.items()):
+                print('{:<48} {:>14.4g} {}'.format(name, result['value'], result['unit']))
+            report['results'].update(results)
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as f:
+            return compare(json.load(f), report, args.tolerance)
+    return 0
+
+
+def compare(baseline, report, tolerance):
+    """print the change of every result found in both reports, return 1 if
+    any got worse by more than tolerance (a fraction)"""
+    regressions = 0
+    old_results = baseline['results']
+    for name, new in sorted(report['results'].items()):
+        if name not in old_results:
+            continue
+        old = old_results[name]['value']
+        change = new['value'] / old - 1 if old else 0.0
+        worse = -change if new['higher_is_better'] else change
+        flag = ''
+        if worse > tolerance:
+            flag = 'REGRESSION'
+            regressions += 1
+        print('{:<48} {:>12.4g} {:>12.4g} {:>+8.1%} {}'.format(name, old, new['value'], change, flag))
+    if baseline.get('environment', {}).get('platform') != report.get('environment', {}).get('platform'):
+        print('warning: the reports come from different platforms')
+    print('{} regression(s) beyond {:.0%}'.format(regressions, tolerance))
+    return 1 if regressions else 0
+
+
+def _compare_files(args):
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.report) as f:
+        report = json.load(f)
+    return compare(baseline, report, args.tolerance)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='benchmark the engine hot paths')
+    sub = parser.add_subparsers(dest='command')
+    run_parser = sub.add_parser('run', help='run benchmarks')
+    run_parser.add_argument('--sizes', type=int, nargs='+', default=[8, 15], help='board sizes')
+    run_parser.add_argument('--only', nargs='+', choices=GROUPS, default=list(GROUPS), help='groups to run')
+    run_parser.add_argument('--playouts', type=int, default=400, help='playouts per search')
+    run_parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 2, 4, 8, 16, 32, 64, 128, 256])
+    run_parser.add_argument('--games', type=int, default=1, help='self-play games to time')
+    run_parser.add_argument('--min-time', type=float, default=1.0, help='seconds to time each path')
+    run_parser.add_argument('--out', help='write the results to this JSON file')
+    run_parser.add_argument('--baseline', help='compare with this earlier JSON report')
+    run_parser.add_argument('--tolerance', type=float, default=0.1, help='slowdown flagged as a regression')
+    run_parser.set_defaults(func=run)
+    compare_parser = sub.add_parser('compare', help='compare two JSON reports')
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('report')
+    compare_parser.add_argument('--tolerance', type=float, default=0.1)
+    compare_parser.set_defaults(func=_compare_files)
+    args = parser.parse_args(argv)
+    if args.command is None:
+        parser.print_help()
+        return 2
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,10 +1,10 @@
-from collections import deque
-
-
 class Conf:
     board_width = 8
     board_height = 8
     n_in_row = 5
+    n_history = 1  # past positions in the network input, the saved models use 1
+    candidate_distance = 0  # search only empty points this close to a stone, 0 = whole board, 2 suits 15x15
+    compact_board = False  # use game.ArrayBoard instead of the dict/list based Board
     learn_rate = 2e-3
     l2_const = 1e-4
     lr_multiplier = 1.0
@@ -12,15 +12,37 @@ class Conf:
     n_playout = 400  # Number of simulations per move in the real game
     episode_len = 0
     c_puct = 5
+    array_tree = False  # store the search tree in NumPy arrays (mcts_array.ArrayTree)
+    move_time = None  # seconds per move in play.py instead of a fixed n_playout, e.g. 2.0
+    reuse_tree = True  # keep the search tree across moves outside self-play
+    ponder = False  # in play.py, keep searching while the human thinks
+    use_tactics = False  # play forced wins, blocks and VCF wins without search (tactics.py)
+    eval_cache_size = 0  # positions kept in the eval_cache.EvalCache LRU, 0 disables it
+    leaf_batch_size = 1  # leaves evaluated per network call, > 1 enables virtual loss batching
+    inference_backend = 'keras'  # 'numpy' plays and self-plays with policy_numpy, without TensorFlow
+    inference_precision = 'float32'  # 'int8': numpy backend weights in less memory but slower, see policy_numpy.py
+    search_stats_file = None  # append per-move and per-game search phase timings here as JSON lines
     buffer_size = 10000
+    augment = 'lazy'  # 'lazy': one random symmetry per sample in policy_update, 'eager': store all 8
     batch_size = 512  # mini-batch size for training
-    data_buffer = deque(maxlen=buffer_size)
+    # memory-mapped replay buffer file, reopened on restart (set init_model to resume the net too)
+    buffer_path = None
+    buffer_readonly = False  # train on a buffer filled by another run, without self-play
+    data_buffer = None  # the ReplayBuffer, opened by train.run from the settings above
     play_batch_size = 1
+    n_selfplay_workers = 0  # self-play processes, 0 plays in the trainer process
+    inference_server = False  # workers send positions to one batched InferenceServer in the trainer
+    inference_max_batch_size = 64
+    inference_max_wait = 0.002  # seconds the server waits to fill a batch
     epochs = 5  # num of train_steps for each update
     kl_targ = 0.02
     check_freq = 100
+    metrics_file = None  # per-batch training metrics (metrics.Metrics), JSON lines or .csv
     game_batch_num = 3000
     best_win_ratio = 0.0
     pure_mcts_playout_num = 1000
+    n_eval_games = 10
+    n_eval_workers = 0  # processes playing evaluation games, 0 plays them in the trainer
+    eval_async = False  # evaluate a weights snapshot in the background while training continues
     init_model = None  # start training from an initial policy-value net or not
     model_file = 'best_policy_8.model'  # for the 8x8 board
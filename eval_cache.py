@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+import time
+from collections import OrderedDict
+
+
+class EvalCache(object):
+    """LRU cache in front of a policy_value_fn.
+
+    Positions are keyed on (Board.zobrist, player to move, last n_history
+    moves). The network input shows the last move and, with n_history > 1,
+    the stones of the earlier positions, which the stones now on the board
+    and the moves since then determine. Cached results are only valid for
+    the weights they were computed with, so call clear() whenever the
+    network is updated.
+    """
+
+    def __init__(self, policy_value_fn, max_size=100000):
+        self._policy = policy_value_fn
+        self.max_size = max_size
+        self._cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.miss_time = 0.0
+
+    def __call__(self, board):
+        key = self.key(board)
+        hit = self.lookup(key)
+        if hit is not None:
+            return hit
+        start = time.time()
+        act_probs, value = self._policy(board)
+        act_probs = list(act_probs)
+        return self.insert(key, act_probs, value, time.time() - start)
+
+    def key(self, board):
+        return (board.zobrist, board.current_player, board.recent_moves(board.n_history))
+
+    def lookup(self, key):
+        """(act_probs, value) cached for key, None on a miss. Batched
+        searches look leaves up here and insert() what the batch computed"""
+        entry = self._cache.get(key)
+        if entry is None:
+            return None
+        self._cache.move_to_end(key)
+        self.hits += 1
+        acts, probs, value = entry
+        return zip(acts, probs), value
+
+    def insert(self, key, act_probs, value, miss_time=0.0):
+        """count a miss taking miss_time seconds and cache its result"""
+        self.miss_time += miss_time
+        self.misses += 1
+        act_probs = list(act_probs)
+        acts = [act for act, _ in act_probs]
+        probs = [prob for _, prob in act_probs]
+        self._cache[key] = (acts, probs, value)
+        if len(self._cache) > self.max_size:
+            self._cache.popitem(last=False)
+        return zip(acts, probs), value
+
+    def clear(self):
+        self._cache.clear()
+
+    def stats(self):
+        """hit rate, and inference time saved assuming every hit would
+        have cost as much as an average miss"""
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._cache),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': 1.0 * self.hits / lookups if lookups else 0.0,
+            'saved_time': self.hits * self.miss_time / self.misses if self.misses else 0.0,
+        }
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+import multiprocessing
+from collections import defaultdict
+
+# per process state of an evaluation worker, built by _init_worker
+_net = None
+_game = None
+_weights_id = None
+
+
+def _init_worker():
+    # imported here so that every process builds its own Keras session
+    global _net, _game
+    from game import Board, ArrayBoard, Game
+    from policy import inference_net
+    from config import Conf
+
+    board_class = ArrayBoard if Conf.compact_board else Board
+    _game = Game(board_class(width=Conf.board_width,
+                             height=Conf.board_height,
+                             n_in_row=Conf.n_in_row,
+                             n_history=Conf.n_history,
+                             candidate_distance=Conf.candidate_distance))
+    _net = inference_net()
+
+
+def _play_game(task):
+    """play one game of the network against pure MCTS, return the winner
+    from the network's point of view (1 win, 2 loss, -1 tie)"""
+    global _weights_id
+    from mcts_pure import MCTSPlayer as MCTS_Pure
+    from mcts_alphaZero import MCTSPlayer
+    from config import Conf
+
+    weights_id, weights, start_player, pure_mcts_playout_num = task
+    if weights_id != _weights_id:
+        _net.set_policy_param(weights)
+        _weights_id = weights_id
+    # no tree reuse, see train.policy_evaluate
+    current_mcts_player = MCTSPlayer(_net.policy_value_fn,
+                                     c_puct=Conf.c_puct,
+                                     n_playout=Conf.n_playout,
+                                     array_tree=Conf.array_tree,
+                                     batch_size=Conf.leaf_batch_size,
+                                     batch_policy_fn=_net.policy_value_batch_fn,
+                                     use_tactics=Conf.use_tactics)
+    pure_mcts_player = MCTS_Pure(c_puct=5,
+                                 n_playout=pure_mcts_playout_num,
+                                 array_tree=Conf.array_tree,
+                                 use_tactics=Conf.use_tactics)
+    return _game.start_play(current_mcts_player, pure_mcts_player,
+                            start_player=start_player, is_shown=0)
+
+
+def win_ratio(winners):
+    """score a list of game results, ties count half"""
+    win_cnt = defaultdict(int)
+    for winner in winners:
+        win_cnt[winner] += 1
+    return 1.0 * (win_cnt[1] + 0.5 * win_cnt[-1]) / len(winners), win_cnt
+
+
+class Evaluator(object):
+    """plays checkpoint evaluation games in a pool of worker processes.
+
+    Each worker builds one network and loads the weights snapshot that
+    comes with a game only when it differs from the one it has. submit()
+    returns at once, the games run in the background while training goes
+    on with the live network, and result() picks up the outcome.
+    """
+
+    def __init__(self, n_workers):
+        ctx = multiprocessing.get_context('spawn')
+        self._pool = ctx.Pool(n_workers, initializer=_init_worker)
+        self._n_submitted = 0
+        self._pending = None
+
+    def submit(self, weights, n_games, pure_mcts_playout_num):
+        """start evaluating a snapshot of the weights, games alternate the
+        first player as in a serial evaluation"""
+        self._n_submitted += 1
+        tasks = [(self._n_submitted, weights, i % 2, pure_mcts_playout_num) for i in range(n_games)]
+        self._pending = (weights, pure_mcts_playout_num, self._pool.map_async(_play_game, tasks, chunksize=1))
+
+    def busy(self):
+        return self._pending is not None and not self._pending[2].ready()
+
+    def result(self, timeout=None):
+        """return (win_ratio, win_cnt, weights, pure_mcts_playout_num) of the
+        submitted evaluation, None if it has not finished within timeout
+        or nothing was submitted"""
+        if self._pending is None:
+            return None
+        weights, pure_mcts_playout_num, async_result = self._pending
+        async_result.wait(timeout)
+        if not async_result.ready():
+            return None
+        self._pending = None
+        ratio, win_cnt = win_ratio(async_result.get())
+        return ratio, win_cnt, weights, pure_mcts_playout_num
+
+    def close(self):
+        self._pool.terminate()
+        self._pool.join()
@@ -1,6 +1,24 @@
+import copy
+import queue
+import random
+import threading
+import time
+import traceback
 import numpy as np
 import tkinter as tk
 import tkinter.messagebox
+from search_stats import SearchStats
+
+_zobrist_tables = {}
+
+
+def _zobrist_table(size, players):
+    """fixed random 64-bit keys, one per (player, move)"""
+    if size not in _zobrist_tables:
+        rng = random.Random(size)
+        _zobrist_tables[size] = {p: [rng.getrandbits(64) for _ in range(size)]
+                                 for p in players}
+    return _zobrist_tables[size]
 
 
 class Board(object):
@@ -16,6 +34,12 @@ class Board(object):
         # need how many pieces in a row to win
         self.n_in_row = int(kwargs.get('n_in_row', 5))
         self.players = [1, 2]  # player1 and player2
+        # number of past positions given to the network as stone planes
+        self.n_history = int(kwargs.get('n_history', 1))
+        self.n_planes = 2 * self.n_history + 2
+        # sensible_moves() only returns empty points within this many rows,
+        # columns or diagonals of a stone, 0 returns every available move
+        self.candidate_distance = int(kwargs.get('candidate_distance', 0))
 
     def init_board(self, start_player=0):
         if self.width < self.n_in_row or self.height < self.n_in_row:
@@ -26,6 +50,25 @@ class Board(object):
         self.availables = list(range(self.width * self.height))
         self.states = {}
         self.last_move = -1
+        # winner is tracked incrementally by do_move, -1 means no winner yet
+        self.winner = -1
+        # (move, last_move, winner) for every move played, used by undo_move
+        self._history = []
+        # Zobrist hash of the stones on the board, updated by do_move/undo_move
+        self.zobrist = 0
+        # network input planes kept up to date by do_move/undo_move, one
+        # flat buffer per player to move, rows already in current_state
+        # order: own and opponent stones for each of the last n_history
+        # positions, then the last move and the colour to play
+        size = self.width * self.height
+        self._planes = {p: np.zeros(self.n_planes * size, dtype=np.float32)
+                        for p in self.players}
+        self._planes[self.current_player][-size:] = 1.0
+        if self.candidate_distance > 0:
+            # stones within candidate_distance of each point, and the empty
+            # points with at least one, kept by do_move/undo_move
+            self._near = [0] * size
+            self._candidates = {}
 
     def move_to_location(self, move):
         """
@@ -51,72 +94,184 @@ class Board(object):
 
     def current_state(self):
         """return the board state from the perspective of the current player.
-        state shape: 4*width*height
+        state shape: n_planes*height*width, with n_planes = 4 for the
+        default single position of history
         """
-
-        square_state = np.zeros((4, self.width, self.height))
-        if self.states:
-            moves, players = np.array(list(zip(*self.states.items())))
-            move_curr = moves[players == self.current_player]
-            move_oppo = moves[players != self.current_player]
-            square_state[0][move_curr // self.width,
-                            move_curr % self.height] = 1.0
-            square_state[1][move_oppo // self.width,
-                            move_oppo % self.height] = 1.0
-            # indicate the last move location
-            square_state[2][self.last_move // self.width,
-                            self.last_move % self.height] = 1.0
-        if len(self.states) % 2 == 0:
-            square_state[3][:, :] = 1.0  # indicate the colour to play
-        return square_state[:, ::-1, :]
+        return self._planes[self.current_player].reshape(
+            self.n_planes, self.height, self.width).copy()
+
+    def write_state(self, out):
+        """write current_state into out, e.g. a slot of a batch array. The
+        planes only hold 0 and 1, so out may be any numeric dtype"""
+        np.copyto(out, self._planes[self.current_player].reshape(
+            self.n_planes, self.height, self.width), casting='unsafe')
+
+    def _plane_offset(self, move):
+        """index of move inside one flat plane, rows flipped as in
+        current_state"""
+        return (self.height - 1 - move // self.width) * self.width + move % self.width
+
+    def _update_planes(self, move, player, opponent):
+        size = self.width * self.height
+        stones = 2 * self.n_history
+        own = self._planes[player]
+        oppo = self._planes[opponent]
+        if self.n_history > 1:
+            own[2 * size:stones * size] = own[:(stones - 2) * size]
+            oppo[2 * size:stones * size] = oppo[:(stones - 2) * size]
+        i = self._plane_offset(move)
+        own[i] = 1.0
+        oppo[size + i] = 1.0
+        last = stones * size
+        if self.last_move != -1:
+            j = last + self._plane_offset(self.last_move)
+            own[j] = 0.0
+            oppo[j] = 0.0
+        own[last + i] = 1.0
+        oppo[last + i] = 1.0
+
+    def _revert_planes(self, move, player, opponent, last_move):
+        size = self.width * self.height
+        stones = 2 * self.n_history
+        own = self._planes[player]
+        oppo = self._planes[opponent]
+        i = self._plane_offset(move)
+        if self.n_history > 1:
+            own[:(stones - 2) * size] = own[2 * size:stones * size]
+            oppo[:(stones - 2) * size] = oppo[2 * size:stones * size]
+            # the oldest position dropped out of the planes, rebuild it
+            oldest = (stones - 2) * size
+            own[oldest:stones * size] = 0.0
+            oppo[oldest:stones * size] = 0.0
+            for old_move, _, _ in self._history[:max(len(self._history) - self.n_history + 1, 0)]:
+                j = self._plane_offset(old_move)
+                if self.states[old_move] == player:
+                    own[oldest + j] = 1.0
+                    oppo[oldest + size + j] = 1.0
+                else:
+                    own[oldest + size + j] = 1.0
+                    oppo[oldest + j] = 1.0
+        else:
+            own[i] = 0.0
+            oppo[size + i] = 0.0
+        last = stones * size
+        own[last + i] = 0.0
+        oppo[last + i] = 0.0
+        if last_move != -1:
+            j = last + self._plane_offset(last_move)
+            own[j] = 1.0
+            oppo[j] = 1.0
+
+    def sensible_moves(self):
+        """candidate moves for search: the empty points near a stone, or
+        the centre on an empty board, see candidate_distance"""
+        if self.candidate_distance <= 0:
+            return self.availables
+        if not self.states:
+            return [(self.height // 2) * self.width + self.width // 2]
+        return list(self._candidates) or self.availables
+
+    def _add_candidates(self, move):
+        self._candidates.pop(move, None)
+        near = self._near
+        for i in _neighbour_table(self.width, self.height, self.candidate_distance)[move]:
+            near[i] += 1
+            if near[i] == 1 and i not in self.states:
+                self._candidates[i] = None
+
+    def _remove_candidates(self, move):
+        near = self._near
+        for i in _neighbour_table(self.width, self.height, self.candidate_distance)[move]:
+            near[i] -= 1
+            if near[i] == 0:
+                self._candidates.pop(i, None)
+        if near[move] > 0:
+            self._candidates[move] = None
 
     def do_move(self, move):
+        self._remove_available(move)
+        self._history.append((move, self.last_move, self.winner))
         self.states[move] = self.current_player
-        self.availables.remove(move)
-        self.current_player = (
+        self.zobrist ^= _zobrist_table(self.width * self.height, self.players)[self.current_player][move]
+        if self.winner == -1 and self._is_winning_move(move):
+            self.winner = self.current_player
+        opponent = (
             self.players[0] if self.current_player == self.players[1]
             else self.players[1]
         )
+        self._update_planes(move, self.current_player, opponent)
+        if self.candidate_distance > 0:
+            self._add_candidates(move)
+        self.current_player = opponent
         self.last_move = move
 
-    def has_a_winner(self):
+    def undo_move(self):
+        """take back the last move, restoring last_move, current_player
+        and the winner"""
+        move, last_move, winner = self._history.pop()
+        self.current_player = self.states.pop(move)
+        self.zobrist ^= _zobrist_table(self.width * self.height, self.players)[self.current_player][move]
+        self._revert_planes(move, self.current_player,
+                            self.players[0] if self.current_player == self.players[1] else self.players[1],
+                            last_move)
+        self._restore_available(move)
+        if self.candidate_distance > 0:
+            self._remove_candidates(move)
+        self.last_move = last_move
+        self.winner = winner
+
+    def move_history(self):
+        """moves played since init_board, in order"""
+        return [move for move, _, _ in self._history]
+
+    def recent_moves(self, n):
+        """the last n moves played, oldest first"""
+        return tuple(move for move, _, _ in self._history[-n:])
+
+    def undo_to(self, n_moves):
+        """undo moves until only n_moves stones are left on the board"""
+        while len(self._history) > n_moves:
+            self.undo_move()
+
+    def _remove_available(self, move):
+        self.availables.remove(move)
+
+    def _restore_available(self, move):
+        self.availables.append(move)
+
+    def _is_winning_move(self, move):
+        """check only the four lines through the stone just placed"""
         width = self.width
         height = self.height
         states = self.states
         n = self.n_in_row
+        player = states[move]
+        h = move // width
+        w = move % width
+
+        for dh, dw in ((0, 1), (1, 0), (1, 1), (1, -1)):
+            count = 1
+            for sign in (1, -1):
+                i = h + sign * dh
+                j = w + sign * dw
+                while (0 <= i < height and 0 <= j < width and
+                       states.get(i * width + j, -1) == player):
+                    count += 1
+                    i += sign * dh
+                    j += sign * dw
+            if count >= n:
+                return True
+        return False
 
-        moved = list(set(range(width * height)) - set(self.availables))
-        if len(moved) < self.n_in_row * 2 - 1:
-            return False, -1
-
-        for m in moved:
-            h = m // width
-            w = m % width
-            player = states[m]
-
-            if (w in range(width - n + 1) and
-                    len(set(states.get(i, -1) for i in range(m, m + n))) == 1):
-                return True, player
-
-            if (h in range(height - n + 1) and
-                    len(set(states.get(i, -1) for i in range(m, m + n * width, width))) == 1):
-                return True, player
-
-            if (w in range(width - n + 1) and h in range(height - n + 1) and
-                    len(set(states.get(i, -1) for i in range(m, m + n * (width + 1), width + 1))) == 1):
-                return True, player
-
-            if (w in range(n - 1, width) and h in range(height - n + 1) and
-                    len(set(states.get(i, -1) for i in range(m, m + n * (width - 1), width - 1))) == 1):
-                return True, player
-
+    def has_a_winner(self):
+        if self.winner != -1:
+            return True, self.winner
         return False, -1
 
     def game_end(self):
         """Check whether the game is ended or not"""
-        win, winner = self.has_a_winner()
-        if win:
-            return True, winner
+        if self.winner != -1:
+            return True, self.winner
         elif not len(self.availables):
             return True, -1
         return False, -1
@@ -125,11 +280,135 @@ class Board(object):
         return self.current_player
 
 
+_line_tables = {}
+
+
+def _line_table(width, height, n):
+    """for every move, the points up to n-1 steps away along the four lines
+    through it, as (forward, backward) index lists ordered by distance"""
+    key = (width, height, n)
+    if key not in _line_tables:
+        table = []
+        for move in range(width * height):
+            h = move // width
+            w = move % width
+            lines = []
+            for dh, dw in ((0, 1), (1, 0), (1, 1), (1, -1)):
+                pair = []
+                for sign in (1, -1):
+                    points = []
+                    for k in range(1, n):
+                        i = h + sign * k * dh
+                        j = w + sign * k * dw
+                        if not (0 <= i < height and 0 <= j < width):
+                            break
+                        points.append(i * width + j)
+                    pair.append(points)
+                lines.append(tuple(pair))
+            table.append(lines)
+        _line_tables[key] = table
+    return _line_tables[key]
+
+
+_windows_cache = {}
+
+
+def _windows(width, height, n):
+    """every run of n consecutive points along a row, column or diagonal,
+    as an (n_windows, n) array of moves"""
+    key = (width, height, n)
+    if key not in _windows_cache:
+        windows = []
+        for dh, dw in ((0, 1), (1, 0), (1, 1), (1, -1)):
+            for h in range(height):
+                for w in range(width):
+                    end_h = h + (n - 1) * dh
+                    end_w = w + (n - 1) * dw
+                    if 0 <= end_h < height and 0 <= end_w < width:
+                        windows.append([(h + k * dh) * width + w + k * dw for k in range(n)])
+        _windows_cache[key] = np.array(windows, dtype=np.intp).reshape(-1, n)
+    return _windows_cache[key]
+
+
+_neighbour_tables = {}
+
+
+def _neighbour_table(width, height, d):
+    """for every move, the other points at most d rows and d columns away"""
+    key = (width, height, d)
+    if key not in _neighbour_tables:
+        table = []
+        for move in range(width * height):
+            h = move // width
+            w = move % width
+            table.append([i * width + j
+                          for i in range(max(h - d, 0), min(h + d + 1, height))
+                          for j in range(max(w - d, 0), min(w + d + 1, width))
+                          if (i, j) != (h, w)])
+        _neighbour_tables[key] = table
+    return _neighbour_tables[key]
+
+
+class ArrayBoard(Board):
+    """compact board with O(1) move bookkeeping.
+
+    Stones are also kept in a flat list for the win check and the position
+    of every empty point inside `availables` is indexed, so a move is
+    removed by swapping it with the last entry instead of `list.remove`.
+    The order of `availables` is therefore not sorted.
+    """
+
+    def init_board(self, start_player=0):
+        super(ArrayBoard, self).init_board(start_player)
+        # a plain list, indexing it is much cheaper than a numpy array
+        self._grid = [0] * (self.width * self.height)
+        # position of each move in availables, -1 once it is taken
+        self._avail_index = list(range(self.width * self.height))
+
+    def _remove_available(self, move):
+        if not 0 <= move < len(self._avail_index) or self._avail_index[move] < 0:
+            raise ValueError('move {} is not available'.format(move))
+        i = self._avail_index[move]
+        last = self.availables.pop()
+        if last != move:
+            self.availables[i] = last
+            self._avail_index[last] = i
+        self._avail_index[move] = -1
+        self._grid[move] = self.current_player
+
+    def _restore_available(self, move):
+        self._avail_index[move] = len(self.availables)
+        self.availables.append(move)
+        self._grid[move] = 0
+
+    def _is_winning_move(self, move):
+        grid = self._grid
+        player = grid[move]
+        lines = _line_table(self.width, self.height, self.n_in_row)[move]
+        for forward, backward in lines:
+            count = 1
+            for i in forward:
+                if grid[i] != player:
+                    break
+                count += 1
+            for i in backward:
+                if grid[i] != player:
+                    break
+                count += 1
+            if count >= self.n_in_row:
+                return True
+        return False
+
+
 class Game(object):
     """game server"""
 
-    def __init__(self, board, **kwargs):
+    def __init__(self, board, stats_sink=None, **kwargs):
         self.board = board
+        # with a player that has enable_stats() on, start_self_play sums the
+        # search stats of its moves into game_stats and passes them to stats_sink
+        self.stats_sink = stats_sink
+        self.game_stats = None
 
     def graphic(self, board, player1, player2):
         """Draw the board and show game info"""
@@ -190,12 +469,22 @@ class Game(object):
         self.board.init_board()
         p1, p2 = self.board.players
         states, mcts_probs, current_players = [], [], []
+        game_stats = None
+        start = time.time()
         while True:
             move, move_probs = player.get_action(self.board,
                                                  temp=temp,
                                                  return_prob=1)
-            # store the data
-            states.append(self.board.current_state())
+            if getattr(player, 'last_stats', None) is not None:
+                if game_stats is None:
+                    game_stats = SearchStats()
+                game_stats.add(player.last_stats)
+                record_start = time.perf_counter()
+                states.append(self.board.current_state())
+                game_stats.count('record', time.perf_counter() - record_start)
+            else:
+                # store the data
+                states.append(self.board.current_state())
             mcts_probs.append(move_probs)
             current_players.append(self.board.current_player)
             # perform a move
@@ -211,6 +500,10 @@ class Game(object):
                     winners_z[np.array(current_players) != winner] = -1.0
                 # reset MCTS root node
                 player.reset_player()
+                self.game_stats = game_stats
+                if game_stats is not None and self.stats_sink is not None:
+                    self.stats_sink(dict(game_stats.to_dict(), event='game', moves=len(states),
+                                         winner=int(winner), game_time=time.time() - start))
                 if is_shown:
                     if winner != -1:
                         print("Game end. Winner is player:", winner)
@@ -220,12 +513,15 @@ class Game(object):
 
 
 class GUI_interface(object):
-    def __init__(self, width, height, n, player, start_player=1):
-        self.board = Board(width=width, height=height, n_in_row=n)
+    def __init__(self, width, height, n, player, start_player=1, board_class=Board, ponder=False,
+                 **board_kwargs):
+        self.board = board_class(width=width, height=height, n_in_row=n, **board_kwargs)
         self.game = Game(self.board)
         self.start_player = start_player
         self.board.init_board(start_player - 1)
         self.player = player
+        # let the player search during the human's turn, see MCTSPlayer.ponder
+        self.ponder = ponder
         p1, p2 = self.board.players
         player.set_player_ind(p1)
         self.filenum = 1
@@ -266,14 +562,18 @@ class GUI_interface(object):
         self._playboard.columnconfigure(0, weight=1)
         self._playboard.columnconfigure(1, weight=1)
         self._playboard.columnconfigure(2, weight=1)
-        current_player = self.board.get_current_player()
-        if current_player == 1:
-            move = self.player.get_action(self.board)
-            self.board.do_move(move)
-            self._draw_all()
-            self._player['text'] = f'Turn: Player{self.get_turn()}'
+        # the AI searches on a worker thread, which posts its move here
+        self._results = queue.Queue()
+        self._worker = None
+        self._search_id = 0
+        if self.board.get_current_player() == self.player.player:
+            self._start_ai_move()
 
     def _on_canvas_clicked(self, event: tk.Event) -> None:
+        if self._worker is not None or self.get_turn() == self.player.player:
+            # the AI's turn, the board is not the human's
+            self._playboard.bell()
+            return
         self._player['text'] = f'Turn: Player{self.get_turn()}'
         pixel_width = self._canvas.winfo_width()
         pixel_height = self._canvas.winfo_height()
@@ -304,24 +604,81 @@ class GUI_interface(object):
 
     def play_against(self, event: tk.Event):
         end, winner = self.board.game_end()
-        if end == False:
-            self._player['text'] = f'Turn: Player{self.get_turn()}'
-            move = self.player.get_action(self.board)
-            self.board.do_move(move)
-            self._draw_all()
-            # im = ImageGrab.grab()
-            # im.save('./' + str(self.filenum) + '.jpg')
-            # im.close()
-            # self.filenum = self.filenum + 1
-            end, winner = self.board.game_end()
-            if end == True:
-                if winner != -1:
-                    tk.messagebox.showinfo('GOBANG', 'The winner is player' + str(winner))
-                else:
-                    tk.messagebox.showinfo('GOBANG', 'Tie')
-                self.destroy()
+        if not end and self._worker is None and self.get_turn() == self.player.player:
+            self._start_ai_move()
+
+    def _start_ai_move(self):
+        """search on a worker thread over a copy of the board, _poll_ai
+        picks up the move"""
+        self._search_id += 1
+        board = copy.deepcopy(self.board)
+        self._worker = threading.Thread(target=self._search, args=(self._search_id, board, self._results))
+        self._worker.daemon = True
+        self._worker.start()
+        self._poll_ai()
+
+    def _search(self, search_id, board, results):
+        try:
+            results.put((search_id, self.player.get_action(board), None))
+        except Exception:
+            # reported on the Tk thread by _poll_ai
+            results.put((search_id, None, traceback.format_exc()))
+
+    def _poll_ai(self):
+        try:
+            search_id, move, error = self._results.get_nowait()
+        except queue.Empty:
+            self._player['text'] = 'Thinking... {} playouts'.format(self.player.search_progress())
+            self._after_id = self._playboard.after(50, self._poll_ai)
+            return
+        self._worker = None
+        if search_id != self._search_id:
+            # a cancelled search, its move is no longer wanted
+            return
+        if error is not None:
+            # still the AI's turn, the human cannot play until a search succeeds
+            print(error)
+            self._player['text'] = 'AI search failed, press Restart to play again'
+            if tk.messagebox.askretrycancel('GOBANG', 'The AI search failed:\n' + error.strip().splitlines()[-1]):
+                self._start_ai_move()
+            return
+        self.board.do_move(move)
+        self._draw_all()
+        end, winner = self.board.game_end()
+        if end == True:
+            if winner != -1:
+                tk.messagebox.showinfo('GOBANG', 'The winner is player' + str(winner))
             else:
-                self._player['text'] = f'Turn: Player{self.get_turn()}'
+                tk.messagebox.showinfo('GOBANG', 'Tie')
+            self.destroy()
+        else:
+            self._player['text'] = f'Turn: Player{self.get_turn()}'
+            self._start_pondering()
+
+    def _cancel_ai_move(self, then=None):
+        """stop a running search and drop its move. The search only stops
+        at its next playout, so then is called once the worker has ended,
+        without blocking the Tk thread"""
+        self._search_id += 1
+        if self._worker is not None:
+            self._playboard.after_cancel(self._after_id)
+            self.player.cancel_search()
+        self._wait_for_worker(then)
+
+    def _wait_for_worker(self, then):
+        if self._worker is not None and self._worker.is_alive():
+            # clicks stay blocked while the worker is set
+            self._player['text'] = 'Stopping the search...'
+            self._after_id = self._playboard.after(50, self._wait_for_worker, then)
+            return
+        self._worker = None
+        self._results = queue.Queue()
+        if then is not None:
+            then()
+
+    def _start_pondering(self):
+        if self.ponder:
+            self.player.ponder(self.board)
 
     def _draw_all(self) -> None:
         self._canvas.delete(tk.ALL)
@@ -363,17 +720,24 @@ class GUI_interface(object):
         return self.board.get_current_player()
 
     def destroy(self):
+        # the search thread is a daemon, no need to wait for it
+        self._search_id += 1
+        self.player.cancel_search()
+        if self.ponder:
+            self.player.stop_pondering()
         self._playboard.destroy()
 
     def run(self):
         self._playboard.mainloop()
 
     def restart(self):
+        if self._worker is not None:
+            self._cancel_ai_move(then=self.restart)
+            return
+        self._search_id += 1
+        self.player.reset_player()
         self.board.init_board(self.start_player - 1)
+        self._draw_all()
         self._player['text'] = f'Turn: Player{self.get_turn()}'
-        current_player = self.board.get_current_player()
-        if current_player == 1:
-            move = self.player.get_action(self.board)
-            self.board.do_move(move)
-            self._draw_all()
-            self._player['text'] = f'Turn: Player{self.get_turn()}'
+        if self.get_turn() == self.player.player:
+            self._start_ai_move()
@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+import multiprocessing
+import queue
+import threading
+import time
+import traceback
+from collections import Counter, deque
+
+import numpy as np
+
+
+class InferenceError(RuntimeError):
+    """raised in a client when the server failed to evaluate its positions
+    or has stopped"""
+
+
+class InferenceClient(object):
+    """handle used by one MCTS to send positions to an InferenceServer.
+
+    Clients are created by InferenceServer.client() and may be passed to
+    other processes as Process arguments.
+    """
+
+    def __init__(self, client_id, request_queue, response_queue, stopped, poll_interval=1.0):
+        self._client_id = client_id
+        self._request_queue = request_queue
+        self._response_queue = response_queue
+        self._stopped = stopped
+        self._poll_interval = poll_interval
+
+    def policy_value_batch_fn(self, states, legal_positions):
+        """same contract as PolicyValueNet.policy_value_batch_fn"""
+        self._request_queue.put((self._client_id, time.time(),
+                                 np.asarray(states, dtype=np.float32), legal_positions))
+        while True:
+            try:
+                results = self._response_queue.get(timeout=self._poll_interval)
+                break
+            except queue.Empty:
+                if self._stopped.is_set():
+                    raise InferenceError('the inference server has stopped')
+        if isinstance(results, InferenceError):
+            raise results
+        return [(zip(legal, probs), value)
+                for legal, (probs, value) in zip(legal_positions, results)]
+
+    def policy_value_fn(self, board):
+        """same contract as PolicyValueNet.policy_value_fn"""
+        legal_positions = list(board.sensible_moves())
+        return self.policy_value_batch_fn([board.current_state()], [legal_positions])[0]
+
+
+class InferenceServer(object):
+    """evaluates positions for many MCTS clients with one network.
+
+    A background thread takes requests from a shared queue and coalesces
+    them into one batch until max_batch_size positions are waiting or
+    max_wait seconds have passed since the first one arrived. Each batch
+    is evaluated with a single policy_value call while holding self.lock,
+    so the owner can hold the lock to keep the network still, e.g. during
+    a training step.
+
+    If policy_value raises, the clients of that batch raise InferenceError
+    and the server goes on. Clients waiting on a server that has stopped
+    raise it too.
+    """
+
+    def __init__(self, policy_value, max_batch_size=64, max_wait=0.002, n_latency_samples=10000):
+        self._policy_value = policy_value
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self._ctx = multiprocessing.get_context('spawn')
+        self._request_queue = self._ctx.Queue()
+        self._response_queues = []
+        self.lock = threading.Lock()
+        self._stop = threading.Event()
+        self._stopped = self._ctx.Event()  # seen by the clients
+        self._thread = None
+        self._batch_sizes = Counter()
+        self._latencies = deque(maxlen=n_latency_samples)
+        self._eval_time = 0.0
+
+    def client(self):
+        """create a client, must be called before start()"""
+        response_queue = self._ctx.Queue()
+        self._response_queues.append(response_queue)
+        return InferenceClient(len(self._response_queues) - 1, self._request_queue, response_queue,
+                               self._stopped)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._serve)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self._stopped.set()
+
+    def _collect(self):
+        """wait for a first request, then gather more until the batch is
+        full or max_wait has passed"""
+        try:
+            requests = [self._request_queue.get(timeout=0.1)]
+        except queue.Empty:
+            return []
+        n = len(requests[0][2])
+        deadline = time.time() + self.max_wait
+        while n < self.max_batch_size:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                request = self._request_queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            requests.append(request)
+            n += len(request[2])
+        return requests
+
+    def _serve(self):
+        try:
+            while not self._stop.is_set():
+                requests = self._collect()
+                if requests:
+                    self._evaluate(requests)
+        finally:
+            self._stopped.set()
+
+    def _evaluate(self, requests):
+        start = time.time()
+        states = np.concatenate([request[2] for request in requests])
+        try:
+            with self.lock:
+                act_probs, value = self._policy_value(states)
+        except Exception:
+            error = traceback.format_exc()
+            print('inference server: evaluation failed\n' + error)
+            for client_id in set(request[0] for request in requests):
+                self._response_queues[client_id].put(InferenceError(error))
+            return
+        self._eval_time += time.time() - start
+        self._batch_sizes[len(states)] += 1
+        i = 0
+        for client_id, sent, request_states, legal_positions in requests:
+            self._latencies.append(start - sent)
+            results = []
+            for legal in legal_positions:
+                results.append((act_probs[i][legal], float(value[i][0])))
+                i += 1
+            self._response_queues[client_id].put(results)
+
+    def stats(self):
+        """batch size histogram and queue latency percentiles (ms)"""
+        n_batches = sum(self._batch_sizes.values())
+        n_positions = sum(size * count for size, count in self._batch_sizes.items())
+        latencies = np.array(self._latencies) * 1000.0
+        stats = {
+            'batches': n_batches,
+            'positions': n_positions,
+            'mean_batch_size': 1.0 * n_positions / n_batches if n_batches else 0.0,
+            'batch_size_histogram': dict(sorted(self._batch_sizes.items())),
+            'eval_time': self._eval_time,
+        }
+        if len(latencies):
+            stats['queue_latency_ms'] = {
+                'p50': float(np.percentile(latencies, 50)),
+                'p90': float(np.percentile(latencies, 90)),
+                'p99': float(np.percentile(latencies, 99)),
+                'max': float(latencies.max()),
+            }
+        return stats
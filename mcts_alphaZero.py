@@ -1,7 +1,14 @@
 # -*- coding: utf-8 -*-
 
-import numpy as np
 import copy
+import threading
+import time
+import numpy as np
+import tactics
+from eval_cache import EvalCache
+from mcts_array import ArrayTree
+from search_budget import SearchBudget
+from search_stats import Instrumented
 
 
 def softmax(x):
@@ -16,6 +23,8 @@ class TreeNode(object):
         self._parent = parent
         self._children = {}  # a map from action to TreeNode
         self._n_visits = 0
+        self._n_virtual = 0  # pending virtual losses of batched playouts
+        self._proven = None  # value for the player to move of a settled leaf
         self._Q = 0
         self._u = 0
         self._P = prior_p
@@ -38,10 +47,23 @@ class TreeNode(object):
             self._parent.update_recursive(-leaf_value)
         self.update(leaf_value)
 
+    def add_virtual_loss(self, n):
+        """count n lost visits on this node and all its ancestors"""
+        node = self
+        while node is not None:
+            node._n_virtual += n
+            node = node._parent
+
     def get_value(self, c_puct):
+        n_visits = self._n_visits
+        parent_visits = self._parent._n_visits + self._parent._n_virtual
+        q = self._Q
+        if self._n_virtual:
+            q = (q * n_visits - self._n_virtual) / (n_visits + self._n_virtual)
+            n_visits += self._n_virtual
         self._u = (c_puct * self._P *
-                   np.sqrt(self._parent._n_visits) / (1 + self._n_visits))
-        return self._Q + self._u
+                   np.sqrt(parent_visits) / (1 + n_visits))
+        return q + self._u
 
     def is_leaf(self):
         return self._children == {}
@@ -50,49 +72,267 @@ class TreeNode(object):
         return self._parent is None
 
 
-class MCTS(object):
+class MCTS(Instrumented):
 
-    def __init__(self, policy_value_fn, c_puct=5, n_playout=10000):
+    # phase methods timed by enable_stats()
+    _stats_phases = {'select': '_select_leaf', 'game_end': '_leaf_status', 'evaluate': '_policy',
+                     'batch_evaluate': '_batch_policy', 'expand': '_expand', 'backup': '_backup',
+                     'virtual_loss': '_add_virtual_loss', 'undo': '_undo'}
+
+    def __init__(self, policy_value_fn, c_puct=5, n_playout=10000,
+                 batch_size=1, batch_policy_fn=None, virtual_loss=3, use_tactics=False):
+        """batch_policy_fn takes a list of state planes and a list of legal
+        moves per state, and returns one (action_probs, value) per state.
+        When it is given and batch_size > 1, leaves are collected
+        batch_size at a time using virtual loss and evaluated together.
+        With use_tactics, leaves where the player to move can win at once
+        are scored as proven wins instead of being evaluated. When
+        policy_value_fn is an EvalCache, batched leaves go through it too."""
         self._root = TreeNode(None, 1.0)
         self._policy = policy_value_fn
+        self._cache = policy_value_fn if isinstance(policy_value_fn, EvalCache) else None
         self._c_puct = c_puct
         self._n_playout = n_playout
+        self._batch_size = batch_size
+        self._batch_policy = batch_policy_fn
+        self._virtual_loss = virtual_loss
+        self._use_tactics = use_tactics
+        # number of network calls and of positions evaluated by them
+        self.nn_calls = 0
+        self.nn_positions = 0
+        self.n_proven = 0  # leaves scored as proven wins
+        self.n_pondered = 0  # playouts run by ponder()
+        self.last_search = None
+        # playouts of the running search so far, may be read from another thread
+        self.search_progress = 0
+        # set from another thread to end the running search early
+        self.cancelled = False
+        # moves from the start of the game to the root, None when unknown
+        self._moves = None
 
     def _playout(self, state):
+        """run one playout on state and take its moves back afterwards"""
+        n_moves = len(state.states)
+        try:
+            self._descend(state)
+        finally:
+            self._undo(state, n_moves)
+
+    def _descend(self, state):
+        leaf = self._select_leaf(state)
+        end, leaf_value = self._leaf_status(state, leaf)
+        if not end:
+            action_probs, leaf_value = self._policy(state)
+            self.nn_calls += 1
+            self.nn_positions += 1
+            self._expand(leaf, action_probs)
+
+        self._backup(leaf, -leaf_value)
+
+    def _playout_batch(self, state, n):
+        """run n playouts whose leaves are evaluated in a single batch"""
+        virtual_loss = self._virtual_loss
+        n_moves = len(state.states)
+        leaves = []  # (leaf, index in the batch or None, value) with virtual loss added
+        n_backed_up = 0
+        pending = {}  # leaf node -> index in the batch
+        states = None
+        legal_positions = []
+        keys = []  # EvalCache key of each batch position
+        cache = self._cache
+        try:
+            try:
+                for i in range(n):
+                    leaf = self._select_leaf(state)
+                    end, leaf_value = self._leaf_status(state, leaf)
+                    node = self._leaf_node(leaf)
+                    hit = None
+                    if not end and node not in pending and cache is not None:
+                        key = cache.key(state)
+                        hit = cache.lookup(key)
+                    if end:
+                        entry = (leaf, None, leaf_value)
+                    elif hit is not None:
+                        # expanded at once, later paths of this batch go below it
+                        action_probs, leaf_value = hit
+                        self._expand(leaf, action_probs)
+                        entry = (leaf, None, leaf_value)
+                    else:
+                        if node not in pending:
+                            if states is None:
+                                states = np.empty((n,) + state.current_state().shape, dtype=np.float32)
+                            pending[node] = len(legal_positions)
+                            state.write_state(states[len(legal_positions)])
+                            legal_positions.append(list(state.sensible_moves()))
+                            if cache is not None:
+                                keys.append(key)
+                        entry = (leaf, pending[node], None)
+                    self._add_virtual_loss(leaf, virtual_loss)
+                    leaves.append(entry)
+                    self._undo(state, n_moves)
+            finally:
+                self._undo(state, n_moves)
+
+            results = []
+            if legal_positions:
+                start = time.time()
+                results = self._batch_policy(states[:len(legal_positions)], legal_positions)
+                self.nn_calls += 1
+                self.nn_positions += len(legal_positions)
+                if cache is not None:
+                    miss_time = (time.time() - start) / len(keys)
+                    results = [cache.insert(key, action_probs, leaf_value, miss_time)
+                               for key, (action_probs, leaf_value) in zip(keys, results)]
+            for leaf, index, leaf_value in leaves:
+                self._add_virtual_loss(leaf, -virtual_loss)
+                n_backed_up += 1
+                if index is not None:
+                    action_probs, leaf_value = results[index]
+                    self._expand(leaf, action_probs)
+                self._backup(leaf, -leaf_value)
+        finally:
+            # after an error, no virtual loss may stay in the tree
+            for leaf, _, _ in leaves[n_backed_up:]:
+                self._add_virtual_loss(leaf, -virtual_loss)
+
+    def _leaf_status(self, state, leaf):
+        """(True, value for the player to move) when the leaf needs no
+        evaluation, (False, None) otherwise. Settled leaves are never
+        expanded, their value is kept on the node for later visits"""
+        value = self._proven_value(leaf)
+        if value is not None:
+            return True, value
+        end, winner = state.game_end()
+        if end:
+            value = self._end_value(state, winner)
+        elif self._use_tactics and tactics.winning_moves(state):
+            # proven: the player to move completes a line next move
+            self.n_proven += 1
+            value = 1.0
+        else:
+            return False, None
+        self._set_proven(leaf, value)
+        return True, value
+
+    def _proven_value(self, leaf):
+        return leaf._proven
+
+    def _set_proven(self, leaf, value):
+        leaf._proven = value
+
+    def _end_value(self, state, winner):
+        if winner == -1:
+            return 0.0
+        return 1.0 if winner == state.get_current_player() else -1.0
+
+    def _select_leaf(self, state):
         node = self._root
         while (1):
             if node.is_leaf():
                 break
             action, node = node.select(self._c_puct)
             state.do_move(action)
-
-        action_probs, leaf_value = self._policy(state)
-        end, winner = state.game_end()
-        if not end:
-            node.expand(action_probs)
-        else:
-            if winner == -1:
-                leaf_value = 0.0
+        return node
+
+    def _leaf_node(self, leaf):
+        return leaf
+
+    def _expand(self, leaf, action_probs):
+        leaf.expand(action_probs)
+
+    def _backup(self, leaf, value):
+        leaf.update_recursive(value)
+
+    def _add_virtual_loss(self, leaf, n):
+        leaf.add_virtual_loss(n)
+
+    def _undo(self, state, n_moves):
+        state.undo_to(n_moves)
+
+    def sync(self, state):
+        """move the root to the position of state, keeping the subtree of
+        the moves played since the last search, or start a new tree if
+        state did not continue from the root"""
+        history = state.move_history()
+        if self._moves is None or history[:len(self._moves)] != self._moves:
+            self.update_with_move(-1)
+            self._moves = history
+            return
+        for move in history[len(self._moves):]:
+            self.update_with_move(move)
+
+    def ponder(self, state, stop, max_playouts):
+        """run playouts on state until stop is set or the root has been
+        visited max_playouts times, e.g. in a thread while the opponent
+        thinks. state must be a copy no one else changes"""
+        while not stop.is_set() and self._root_child_visits() < max_playouts:
+            if self._batch_size > 1 and self._batch_policy is not None:
+                self._playout_batch(state, self._batch_size)
+                self.n_pondered += self._batch_size
             else:
-                leaf_value = (
-                    1.0 if winner == state.get_current_player() else -1.0
-                )
-
-        node.update_recursive(-leaf_value)
+                self._playout(state)
+                self.n_pondered += 1
+
+    def _root_child_visits(self):
+        """playouts that went through the root's children so far"""
+        act_visits = list(self._root_visits())
+        return int(np.sum(act_visits[1])) if act_visits else 0
+
+    def get_move_probs(self, state, temp=1e-3, top_up=False, budget=None):
+        """run n_playout playouts, or with top_up only as many as the root
+        is short of n_playout visits from reused or pondered search. A
+        search_budget.SearchBudget replaces n_playout, see last_search for
+        what the search did"""
+        self.sync(state)
+        if budget is None:
+            budget = SearchBudget(self._n_playout)
+        n_done = self._root_child_visits() if top_up else 0
+        budget.start(n_done)
+        self._stats_start()
+        n_start = n_done
+        batched = self._batch_size > 1 and self._batch_policy is not None
+        while True:
+            self.search_progress = n_done - n_start
+            reason = 'cancelled' if self.cancelled else budget.stop_reason(n_done, self._root_visits)
+            if reason is not None:
+                break
+            n = self._batch_size if batched else 1
+            if budget.max_playouts is not None:
+                n = min(n, budget.max_playouts - n_done)
+            if batched:
+                self._playout_batch(state, n)
+            else:
+                self._playout(state)
+            n_done += n
+        self.last_search = {'playouts': n_done - n_start, 'reused': n_start,
+                            'stop_reason': reason, 'time': budget.elapsed()}
+        self._stats_end(n_done - n_start, self.last_search['time'])
+
+        act_visits = list(self._root_visits())
+        if not act_visits or not np.sum(act_visits[1]):
+            # nothing searched, e.g. a cancelled search, fall back on the priors
+            acts, priors = zip(*self._policy(state)[0])
+            return acts, softmax(1.0 / temp * np.log(np.array(priors) + 1e-10))
+        acts, visits = act_visits
+        act_probs = softmax(1.0 / temp * np.log(np.array(visits) + 1e-10))
 
-    def get_move_probs(self, state, temp=1e-3):
-        for n in range(self._n_playout):
-            state_copy = copy.deepcopy(state)
-            self._playout(state_copy)
+        return acts, act_probs
 
+    def _root_visits(self):
         act_visits = [(act, node._n_visits)
                       for act, node in self._root._children.items()]
-        acts, visits = zip(*act_visits)
-        act_probs = softmax(1.0 / temp * np.log(np.array(visits) + 1e-10))
-
-        return acts, act_probs
+        return zip(*act_visits)
 
     def update_with_move(self, last_move):
+        """advance the root to the child of last_move, or start a new tree
+        (-1 to always start one)"""
+        self._advance_root(last_move)
+        if last_move == -1:
+            self._moves = None
+        elif self._moves is not None:
+            self._moves.append(last_move)
+
+    def _advance_root(self, last_move):
         if last_move in self._root._children:
             self._root = self._root._children[last_move]
             self._root._parent = None
@@ -103,24 +343,181 @@ class MCTS(object):
         return "MCTS"
 
 
+class ArrayMCTS(MCTS):
+    """MCTS on an ArrayTree, selecting among all children of a node with
+    one vectorized PUCT expression. Gives the same visit counts as MCTS.
+    A leaf here is the list of node indices from the root down to it."""
+
+    def __init__(self, policy_value_fn, c_puct=5, n_playout=10000,
+                 batch_size=1, batch_policy_fn=None, virtual_loss=3, use_tactics=False):
+        super(ArrayMCTS, self).__init__(policy_value_fn, c_puct, n_playout,
+                                        batch_size, batch_policy_fn, virtual_loss, use_tactics)
+        self._root = None
+        self._tree = ArrayTree()
+
+    def _select_leaf(self, state):
+        tree = self._tree
+        node = 0
+        path = [node]
+        while not tree.is_leaf(node):
+            action, node = tree.select(node, self._c_puct)
+            state.do_move(action)
+            path.append(node)
+        return path
+
+    def _leaf_node(self, leaf):
+        return leaf[-1]
+
+    def _proven_value(self, leaf):
+        value = self._tree.proven[leaf[-1]]
+        return None if np.isnan(value) else float(value)
+
+    def _set_proven(self, leaf, value):
+        self._tree.proven[leaf[-1]] = value
+
+    def _expand(self, leaf, action_probs):
+        self._tree.expand(leaf[-1], action_probs)
+
+    def _backup(self, leaf, value):
+        self._tree.backup(leaf, value)
+
+    def _add_virtual_loss(self, leaf, n):
+        self._tree.add_virtual_loss(leaf, n)
+
+    def _tree_size(self):
+        return self._tree.size
+
+    def _root_visits(self):
+        return self._tree.children(0)
+
+    def _advance_root(self, last_move):
+        child = self._tree.find_child(0, last_move)
+        if child >= 0:
+            self._tree.reroot(child)
+        else:
+            self._tree.reset()
+
+
+def tactics_time_saved(n_tactical, tactics_time, n_searched, search_time):
+    """search time the tactical moves would have cost at the average time
+    per searched move, less the time spent in tactics"""
+    if not n_searched:
+        return 0.0
+    return n_tactical * search_time / n_searched - tactics_time
+
+
 class MCTSPlayer(object):
 
     def __init__(self, policy_value_function,
-                 c_puct=5, n_playout=2000, is_selfplay=0):
-        self.mcts = MCTS(policy_value_function, c_puct, n_playout)
+                 c_puct=5, n_playout=2000, is_selfplay=0, array_tree=False,
+                 batch_size=1, batch_policy_fn=None, use_tactics=False, reuse_tree=False,
+                 time_limit=None, min_playouts=0, max_playouts=None):
+        mcts_class = ArrayMCTS if array_tree else MCTS
+        self.mcts = mcts_class(policy_value_function, c_puct, n_playout,
+                               batch_size, batch_policy_fn, use_tactics=use_tactics)
         self._is_selfplay = is_selfplay
+        # with use_tactics, forced moves found by tactics.find_forced_move
+        # are played without searching
+        self._use_tactics = use_tactics
+        self.n_moves = 0
+        self.search_time = 0.0
+        self.n_tactical = 0
+        self.tactics_time = 0.0
+        # keep the subtree of the chosen move for the next search, self-play
+        # always does
+        self._reuse_tree = is_selfplay or reuse_tree
+        self._n_playout = n_playout
+        self._ponder_thread = None
+        self._ponder_stop = None
+        # with a time_limit (seconds per move) or a deadline passed to
+        # get_action, moves are searched by time instead of n_playout
+        self._time_limit = time_limit
+        self._min_playouts = min_playouts
+        self._max_playouts = max_playouts
+        # playouts, stop_reason and time of the last move, for logging
+        self.last_search = None
+        # search_stats.SearchStats of the last move, None unless enable_stats()
+        # was called or when the move was not searched
+        self.last_stats = None
+
+    def enable_stats(self, sink=None):
+        """time the search phases of every move, see search_stats"""
+        self.mcts.enable_stats(sink)
 
     def set_player_ind(self, p):
         self.player = p
 
     def reset_player(self):
+        self.stop_pondering()
+        self.mcts.cancelled = False
         self.mcts.update_with_move(-1)
 
-    def get_action(self, board, temp=1e-3, return_prob=0):
+    def cancel_search(self):
+        """make a get_action running in another thread return as soon as
+        possible, reset_player() allows searching again"""
+        self.mcts.cancelled = True
+
+    def search_progress(self):
+        """playouts done by the running search"""
+        return self.mcts.search_progress
+
+    def ponder(self, board, max_playouts=None):
+        """keep searching from board in a background thread, e.g. while the
+        opponent thinks, until stop_pondering() or the next get_action().
+        The tree is reused once the opponent's move is known, so this only
+        pays off together with reuse_tree"""
+        self.stop_pondering()
+        state = copy.deepcopy(board)
+        self.mcts.sync(state)
+        self._ponder_stop = threading.Event()
+        self._ponder_thread = threading.Thread(
+            target=self.mcts.ponder,
+            args=(state, self._ponder_stop, max_playouts or 10 * self._n_playout))
+        self._ponder_thread.daemon = True
+        self._ponder_thread.start()
+
+    def stop_pondering(self):
+        if self._ponder_thread is not None:
+            self._ponder_stop.set()
+            self._ponder_thread.join()
+            self._ponder_thread = None
+
+    def _budget(self, deadline):
+        if self._time_limit is None and deadline is None:
+            return None
+        return SearchBudget.timed(self._time_limit, deadline, self._min_playouts, self._max_playouts)
+
+    def get_action(self, board, temp=1e-3, return_prob=0, deadline=None):
+        """deadline: time.time() by which the move must be chosen"""
         sensible_moves = board.availables
         move_probs = np.zeros(board.width * board.height)
         if len(sensible_moves) > 0:
-            acts, probs = self.mcts.get_move_probs(board, temp)
+            budget = self._budget(deadline)
+            self.stop_pondering()
+            if self._reuse_tree:
+                # follow the moves played since the last search, ours and the opponent's
+                self.mcts.sync(board)
+            if self._use_tactics:
+                start = time.time()
+                move, _ = tactics.find_forced_move(board)
+                self.tactics_time += time.time() - start
+                if move is not None:
+                    self.n_tactical += 1
+                    self.last_search = {'playouts': 0, 'reused': 0, 'stop_reason': 'tactics',
+                                        'time': time.time() - start}
+                    self.last_stats = None
+                    move_probs[move] = 1.0
+                    self.mcts.update_with_move(move if self._reuse_tree else -1)
+                    return (move, move_probs) if return_prob else move
+            start = time.time()
+            # outside self-play a reused tree counts towards n_playout
+            acts, probs = self.mcts.get_move_probs(board, temp,
+                                                   top_up=self._reuse_tree and not self._is_selfplay,
+                                                   budget=budget)
+            self.search_time += time.time() - start
+            self.last_search = self.mcts.last_search
+            self.last_stats = self.mcts.move_stats
+            self.n_moves += 1
             move_probs[list(acts)] = probs
             if self._is_selfplay:
                 move = np.random.choice(
@@ -130,7 +527,7 @@ class MCTSPlayer(object):
                 self.mcts.update_with_move(move)
             else:
                 move = np.random.choice(acts, p=probs)
-                self.mcts.update_with_move(-1)
+                self.mcts.update_with_move(move if self._reuse_tree else -1)
 
             if return_prob:
                 return move, move_probs
@@ -139,5 +536,18 @@ class MCTSPlayer(object):
         else:
             print("WARNING: the board is full")
 
+    def get_stats(self):
+        """effective network batch size and search speed so far, and the
+        moves and leaves settled by tactics"""
+        return {
+            'nn_batch_size': 1.0 * self.mcts.nn_positions / max(self.mcts.nn_calls, 1),
+            'moves_per_sec': self.n_moves / self.search_time if self.search_time else 0.0,
+            'tactical_moves': self.n_tactical,
+            'proven_leaves': self.mcts.n_proven,
+            'pondered_playouts': self.mcts.n_pondered,
+            'tactics_time_saved': tactics_time_saved(self.n_tactical, self.tactics_time,
+                                                     self.n_moves, self.search_time),
+        }
+
     def __str__(self):
         return "MCTS {}".format(self.player)
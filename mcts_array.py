@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+
+
+class ArrayTree(object):
+    """MCTS tree stored as a struct of NumPy arrays instead of one TreeNode
+    object per node.
+
+    Node i has visit count N[i], mean value Q[i] and prior P[i]. The children
+    of a node occupy the contiguous index range
+    [first_child[i], first_child[i] + n_children[i]), in the order they were
+    expanded, so PUCT can be evaluated for all of them in one expression.
+    Node 0 is always the root.
+    """
+
+    def __init__(self, capacity=4096):
+        self._allocate(capacity)
+        self.reset()
+        # number of paths currently holding virtual loss
+        self._n_virtual_paths = 0
+
+    def _allocate(self, capacity):
+        self.N = np.zeros(capacity, dtype=np.int64)
+        self.Q = np.zeros(capacity)
+        self.P = np.zeros(capacity)
+        self.action = np.full(capacity, -1, dtype=np.int64)
+        self.parent = np.full(capacity, -1, dtype=np.int64)
+        self.first_child = np.full(capacity, -1, dtype=np.int64)
+        self.n_children = np.zeros(capacity, dtype=np.int64)
+        self.V = np.zeros(capacity, dtype=np.int64)  # pending virtual losses
+        # value for the player to move of a settled leaf, nan until known
+        self.proven = np.full(capacity, np.nan)
+
+    def _fields(self):
+        return ('N', 'Q', 'P', 'action', 'parent', 'first_child', 'n_children', 'V', 'proven')
+
+    def reset(self):
+        self.size = 1
+        self.N[0] = 0
+        self.Q[0] = 0.0
+        self.P[0] = 1.0
+        self.action[0] = -1
+        self.parent[0] = -1
+        self.first_child[0] = -1
+        self.n_children[0] = 0
+        self.V[0] = 0
+        self.proven[0] = np.nan
+
+    def _reserve(self, n):
+        capacity = len(self.N)
+        if self.size + n <= capacity:
+            return
+        while self.size + n > capacity:
+            capacity *= 2
+        for name in self._fields():
+            old = getattr(self, name)
+            new = np.empty(capacity, dtype=old.dtype)
+            new[:self.size] = old[:self.size]
+            setattr(self, name, new)
+
+    def is_leaf(self, node):
+        return self.n_children[node] == 0
+
+    def expand(self, node, action_priors):
+        if self.n_children[node]:
+            return
+        action_priors = list(action_priors)
+        k = len(action_priors)
+        if k == 0:
+            return
+        actions, priors = zip(*action_priors)
+        self._reserve(k)
+        start = self.size
+        end = start + k
+        self.action[start:end] = actions
+        self.P[start:end] = priors
+        self.N[start:end] = 0
+        self.Q[start:end] = 0.0
+        self.parent[start:end] = node
+        self.first_child[start:end] = -1
+        self.n_children[start:end] = 0
+        self.V[start:end] = 0
+        self.proven[start:end] = np.nan
+        self.first_child[node] = start
+        self.n_children[node] = k
+        self.size = end
+
+    def select(self, node, c_puct):
+        """return (action, child) with the highest Q + u among the children"""
+        start = self.first_child[node]
+        end = start + self.n_children[node]
+        if self._n_virtual_paths:
+            virtual = self.V[start:end]
+            n_visits = self.N[start:end] + virtual
+            q = (self.Q[start:end] * self.N[start:end] - virtual) / np.maximum(n_visits, 1)
+            values = q + (c_puct * self.P[start:end] *
+                          np.sqrt(self.N[node] + self.V[node]) / (1 + n_visits))
+        else:
+            values = self.Q[start:end] + (c_puct * self.P[start:end] *
+                                          np.sqrt(self.N[node]) / (1 + self.N[start:end]))
+        child = start + int(np.argmax(values))
+        return int(self.action[child]), child
+
+    def backup(self, path, leaf_value):
+        """update every node on path (root first, leaf last), the leaf gets
+        leaf_value and the sign flips at each level above it"""
+        path = np.asarray(path)
+        values = np.full(len(path), float(leaf_value))
+        values[-2::-2] = -leaf_value
+        self.N[path] += 1
+        self.Q[path] += (values - self.Q[path]) / self.N[path]
+
+    def add_virtual_loss(self, path, n):
+        """count n lost visits on every node of path, n < 0 reverts them"""
+        self.V[np.asarray(path)] += n
+        self._n_virtual_paths += 1 if n > 0 else -1
+
+    def children(self, node):
+        """return (actions, visits) of the children of node"""
+        start = self.first_child[node]
+        end = start + self.n_children[node]
+        return self.action[start:end], self.N[start:end]
+
+    def find_child(self, node, action):
+        start = self.first_child[node]
+        if start < 0:
+            return -1
+        hits = np.flatnonzero(self.action[start:start + self.n_children[node]] == action)
+        return start + int(hits[0]) if len(hits) else -1
+
+    def reroot(self, node):
+        """make node the new root, keeping only its subtree and packing it
+        to the front of the arrays"""
+        order = [node]
+        i = 0
+        while i < len(order):
+            k = self.n_children[order[i]]
+            if k:
+                start = self.first_child[order[i]]
+                order.extend(range(start, start + k))
+            i += 1
+        ids = np.array(order)
+        remap = np.full(self.size, -1, dtype=np.int64)
+        remap[ids] = np.arange(len(ids))
+        parent = self.parent[ids]
+        first_child = self.first_child[ids]
+        for name in ('N', 'Q', 'P', 'action', 'n_children', 'V', 'proven'):
+            arr = getattr(self, name)
+            arr[:len(ids)] = arr[ids]
+        self.parent[:len(ids)] = np.where(parent >= 0, remap[parent], -1)
+        self.parent[0] = -1
+        self.first_child[:len(ids)] = np.where(first_child >= 0, remap[first_child], -1)
+        self.size = len(ids)
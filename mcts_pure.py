@@ -1,17 +1,170 @@
 # -*- coding: utf-8 -*-
+import random
+import time
 import numpy as np
-import copy
-from operator import itemgetter
+import tactics
+from mcts_array import ArrayTree
+from mcts_alphaZero import tactics_time_saved
+from search_budget import SearchBudget
+from search_stats import Instrumented
+from game import _line_table, _neighbour_table, _windows
 
 
-def rollout_policy_fn(board):
-    action_probs = np.random.rand(len(board.availables))
-    return zip(board.availables, action_probs)
+def policy_value_fn(board):
+    moves = board.sensible_moves()
+    action_probs = np.ones(len(moves)) / len(moves)
+    return zip(moves, action_probs), 0
 
 
-def policy_value_fn(board):
-    action_probs = np.ones(len(board.availables)) / len(board.availables)
-    return zip(board.availables, action_probs), 0
+_window_tables = {}
+
+
+def _window_table(width, height, n):
+    """for every point, the ids of the n-in-a-row windows covering it,
+    padded with the unused id n_windows, and n_windows"""
+    key = (width, height, n)
+    if key not in _window_tables:
+        cells = _windows(width, height, n)
+        covering = [[] for _ in range(width * height)]
+        for i, window in enumerate(cells):
+            for move in window:
+                covering[move].append(i)
+        table = np.full((width * height, max(len(ids) for ids in covering)), len(cells), dtype=np.intp)
+        for move, ids in enumerate(covering):
+            table[move, :len(ids)] = ids
+        _window_tables[key] = (table, len(cells))
+    return _window_tables[key]
+
+
+class RolloutEngine(object):
+    """plays random games to the end from a board without touching it.
+
+    run() plays on a private list copy of the stones, draws each move by
+    an incremental Fisher-Yates shuffle of the empty points and checks
+    only the four lines through the stone just placed, so no step
+    allocates. On a board with a candidate_distance, moves are drawn from
+    its sensible_moves() and the empty points near each new stone join
+    them. run_batch() plays n games at once as NumPy arrays over all empty
+    points, keeping the stone count of every player in every n-in-a-row
+    window.
+    """
+
+    def __init__(self):
+        self._key = None
+        self._grid = []
+        self._order = []
+        self._seen = []
+
+    def _prepare(self, board):
+        key = (board.width, board.height, board.n_in_row)
+        if key != self._key:
+            self._key = key
+            self._lines = _line_table(*key)
+            self._empty = [0] * (board.width * board.height)
+            self._grid = list(self._empty)
+            self._seen = list(self._empty)
+        self._grid[:] = self._empty
+        for move, player in board.states.items():
+            self._grid[move] = player
+
+    def run(self, board):
+        """return the winner of one random game from board, -1 for a tie"""
+        end, winner = board.game_end()
+        if end:
+            return winner
+        self._prepare(board)
+        if board.candidate_distance > 0:
+            return self._run_candidates(board)
+        grid = self._grid
+        order = self._order
+        order[:] = board.availables
+        p1, p2 = board.players
+        player = board.get_current_player()
+        rand = random.random
+        k = len(order)
+        for i in range(k):
+            j = i + int(rand() * (k - i))
+            move = order[j]
+            order[j] = order[i]
+            grid[move] = player
+            if self._wins(move, player):
+                return player
+            player = p1 if player == p2 else p2
+        return -1
+
+    def _run_candidates(self, board):
+        grid = self._grid
+        seen = self._seen
+        seen[:] = grid
+        neighbours = _neighbour_table(board.width, board.height, board.candidate_distance)
+        order = self._order
+        order[:] = board.sensible_moves()
+        for move in order:
+            seen[move] = 1
+        p1, p2 = board.players
+        player = board.get_current_player()
+        rand = random.random
+        while order:
+            # swap a random candidate to the end and take it
+            j = int(rand() * len(order))
+            move = order[j]
+            order[j] = order[-1]
+            order.pop()
+            grid[move] = player
+            if self._wins(move, player):
+                return player
+            for i in neighbours[move]:
+                if not seen[i]:
+                    seen[i] = 1
+                    order.append(i)
+            player = p1 if player == p2 else p2
+        return -1
+
+    def _wins(self, move, player):
+        grid = self._grid
+        for forward, backward in self._lines[move]:
+            count = 1
+            for m in forward:
+                if grid[m] != player:
+                    break
+                count += 1
+            for m in backward:
+                if grid[m] != player:
+                    break
+                count += 1
+            if count >= self._key[2]:
+                return True
+        return False
+
+    def run_batch(self, board, n_games):
+        """return the winners of n_games random games from board"""
+        end, winner = board.game_end()
+        if end:
+            return np.full(n_games, winner)
+        table, n_windows = _window_table(board.width, board.height, board.n_in_row)
+        current = board.get_current_player()
+        players = (current, board.players[0] if current == board.players[1] else board.players[1])
+        # stones of players[0] and players[1] in each window, the last one is padding
+        counts = np.zeros((2, n_games, n_windows + 1), dtype=np.int16)
+        for move, player in board.states.items():
+            counts[players.index(player), :, table[move]] += 1
+        moves = np.asarray(board.availables)
+        order = moves[np.argsort(np.random.rand(n_games, len(moves)), axis=1)]
+        winners = np.full(n_games, -1)
+        live = np.arange(n_games)
+        for step in range(len(moves)):
+            side = step % 2
+            windows = table[order[live, step]]
+            count = counts[side]
+            count[live[:, None], windows] += 1
+            count[:, n_windows] = 0
+            won = (count[live[:, None], windows] >= board.n_in_row).any(axis=1)
+            if won.any():
+                winners[live[won]] = players[side]
+                live = live[~won]
+                if not len(live):
+                    break
+        return winners
 
 
 class TreeNode(object):
@@ -20,6 +173,7 @@ class TreeNode(object):
         self._parent = parent
         self._children = {}
         self._n_visits = 0
+        self._proven = None  # value for the player to move of a settled leaf
         self._Q = 0
         self._u = 0
         self._P = prior_p
@@ -54,51 +208,130 @@ class TreeNode(object):
         return self._parent is None
 
 
-class MCTS(object):
+class MCTS(Instrumented):
+
+    # phase methods timed by enable_stats()
+    _stats_phases = {'select': '_select_leaf', 'game_end': '_leaf_status', 'evaluate': '_policy',
+                     'expand': '_expand', 'rollout': '_evaluate_rollout', 'backup': '_backup',
+                     'undo': '_undo'}
 
-    def __init__(self, policy_value_fn, c_puct=5, n_playout=10000):
+    def __init__(self, policy_value_fn, c_puct=5, n_playout=10000, n_rollouts=1, use_tactics=False):
         self._root = TreeNode(None, 1.0)
         self._policy = policy_value_fn
         self._c_puct = c_puct
         self._n_playout = n_playout
+        # random games per leaf, > 1 plays them together with RolloutEngine.run_batch
+        self._n_rollouts = n_rollouts
+        self._rollout = RolloutEngine()
+        # score leaves where the player to move can win at once without a rollout
+        self._use_tactics = use_tactics
+        self.n_proven = 0
+        self.last_search = None
+        self.search_progress = 0  # see mcts_alphaZero.MCTS
+        self.cancelled = False
 
     def _playout(self, state):
+        """run one playout on state and take its moves back afterwards"""
+        n_moves = len(state.states)
+        try:
+            self._descend(state)
+        finally:
+            self._undo(state, n_moves)
+
+    def _descend(self, state):
+        leaf = self._select_leaf(state)
+        leaf_value = self._leaf_status(state, leaf)
+        if leaf_value is None:
+            action_probs, _ = self._policy(state)
+            self._expand(leaf, action_probs)
+            leaf_value = self._evaluate_rollout(state)
+        self._backup(leaf, -leaf_value)
+
+    def _leaf_status(self, state, leaf):
+        """value for the player to move of a finished game or a proven win,
+        None when the leaf needs a rollout. It is kept on the node, settled
+        leaves are never expanded and come back on later playouts"""
+        value = self._proven_value(leaf)
+        if value is not None:
+            return value
+        end, winner = state.game_end()
+        if end:
+            value = 0.0 if winner == -1 else (1.0 if winner == state.get_current_player() else -1.0)
+        elif self._use_tactics and tactics.winning_moves(state):
+            self.n_proven += 1
+            value = 1.0
+        else:
+            return None
+        self._set_proven(leaf, value)
+        return value
+
+    def _proven_value(self, leaf):
+        return leaf._proven
+
+    def _set_proven(self, leaf, value):
+        leaf._proven = value
+
+    def _select_leaf(self, state):
         node = self._root
         while (1):
             if node.is_leaf():
                 break
             action, node = node.select(self._c_puct)
             state.do_move(action)
+        return node
 
-        action_probs, _ = self._policy(state)
-        end, winner = state.game_end()
-        if not end:
-            node.expand(action_probs)
-        leaf_value = self._evaluate_rollout(state)
-        node.update_recursive(-leaf_value)
+    def _expand(self, leaf, action_probs):
+        leaf.expand(action_probs)
+
+    def _backup(self, leaf, value):
+        leaf.update_recursive(value)
 
-    def _evaluate_rollout(self, state, limit=1000):
+    def _undo(self, state, n_moves):
+        state.undo_to(n_moves)
+
+    def _evaluate_rollout(self, state):
+        """value of state for the player to move, from random games"""
         player = state.get_current_player()
-        for i in range(limit):
-            end, winner = state.game_end()
-            if end:
-                break
-            action_probs = rollout_policy_fn(state)
-            max_action = max(action_probs, key=itemgetter(1))[0]
-            state.do_move(max_action)
-        else:
-            print("WARNING: rollout reached the move limit")
+        if self._n_rollouts > 1:
+            winners = self._rollout.run_batch(state, self._n_rollouts)
+            losses = np.count_nonzero((winners != player) & (winners != -1))
+            return 1.0 * (np.count_nonzero(winners == player) - losses) / self._n_rollouts
+        winner = self._rollout.run(state)
         if winner == -1:
             return 0
         else:
             return 1 if winner == player else -1
 
-    def get_move(self, state):
-        for n in range(self._n_playout):
-            state_copy = copy.deepcopy(state)
-            self._playout(state_copy)
-        return max(self._root._children.items(),
-                   key=lambda act_node: act_node[1]._n_visits)[0]
+    def get_move(self, state, budget=None):
+        """run n_playout playouts, or until a search_budget.SearchBudget
+        says stop, see last_search"""
+        if budget is None:
+            budget = SearchBudget(self._n_playout)
+        budget.start()
+        self._stats_start()
+        n_done = 0
+        while True:
+            self.search_progress = n_done
+            reason = 'cancelled' if self.cancelled else budget.stop_reason(n_done, self._root_visits)
+            if reason is not None:
+                break
+            self._playout(state)
+            n_done += 1
+        self.last_search = {'playouts': n_done, 'reused': 0,
+                            'stop_reason': reason, 'time': budget.elapsed()}
+        self._stats_end(n_done, self.last_search['time'])
+        act_visits = list(self._root_visits())
+        if not act_visits or not np.sum(act_visits[1]):
+            # nothing searched, e.g. a cancelled search, fall back on the priors
+            acts, priors = zip(*self._policy(state)[0])
+            return acts[int(np.argmax(priors))]
+        acts, visits = act_visits
+        return acts[int(np.argmax(visits))]
+
+    def _root_visits(self):
+        act_visits = [(act, node._n_visits)
+                      for act, node in self._root._children.items()]
+        return zip(*act_visits)
 
     def update_with_move(self, last_move):
         if last_move in self._root._children:
@@ -111,24 +344,122 @@ class MCTS(object):
         return "MCTS"
 
 
+class ArrayMCTS(MCTS):
+    """pure MCTS on an ArrayTree, see mcts_alphaZero.ArrayMCTS"""
+
+    def __init__(self, policy_value_fn, c_puct=5, n_playout=10000, n_rollouts=1, use_tactics=False):
+        super(ArrayMCTS, self).__init__(policy_value_fn, c_puct, n_playout, n_rollouts, use_tactics)
+        self._root = None
+        self._tree = ArrayTree()
+
+    def _select_leaf(self, state):
+        tree = self._tree
+        node = 0
+        path = [node]
+        while not tree.is_leaf(node):
+            action, node = tree.select(node, self._c_puct)
+            state.do_move(action)
+            path.append(node)
+        return path
+
+    def _expand(self, leaf, action_probs):
+        self._tree.expand(leaf[-1], action_probs)
+
+    def _backup(self, leaf, value):
+        self._tree.backup(leaf, value)
+
+    def _proven_value(self, leaf):
+        value = self._tree.proven[leaf[-1]]
+        return None if np.isnan(value) else float(value)
+
+    def _set_proven(self, leaf, value):
+        self._tree.proven[leaf[-1]] = value
+
+    def _tree_size(self):
+        return self._tree.size
+
+    def _root_visits(self):
+        return self._tree.children(0)
+
+    def update_with_move(self, last_move):
+        child = self._tree.find_child(0, last_move)
+        if child >= 0:
+            self._tree.reroot(child)
+        else:
+            self._tree.reset()
+
+
 class MCTSPlayer(object):
-    def __init__(self, c_puct=5, n_playout=2000):
-        self.mcts = MCTS(policy_value_fn, c_puct, n_playout)
+    def __init__(self, c_puct=5, n_playout=2000, array_tree=False, n_rollouts=1, use_tactics=False,
+                 time_limit=None, min_playouts=0, max_playouts=None):
+        mcts_class = ArrayMCTS if array_tree else MCTS
+        self.mcts = mcts_class(policy_value_fn, c_puct, n_playout, n_rollouts, use_tactics)
+        # see mcts_alphaZero.MCTSPlayer
+        self._use_tactics = use_tactics
+        self.n_moves = 0
+        self.search_time = 0.0
+        self.n_tactical = 0
+        self.tactics_time = 0.0
+        self._time_limit = time_limit
+        self._min_playouts = min_playouts
+        self._max_playouts = max_playouts
+        self.last_search = None
+        self.last_stats = None
+
+    def enable_stats(self, sink=None):
+        """see mcts_alphaZero.MCTSPlayer.enable_stats"""
+        self.mcts.enable_stats(sink)
 
     def set_player_ind(self, p):
         self.player = p
 
     def reset_player(self):
+        self.mcts.cancelled = False
         self.mcts.update_with_move(-1)
 
-    def get_action(self, board):
+    def cancel_search(self):
+        """see mcts_alphaZero.MCTSPlayer.cancel_search"""
+        self.mcts.cancelled = True
+
+    def search_progress(self):
+        return self.mcts.search_progress
+
+    def get_action(self, board, deadline=None):
+        """deadline: time.time() by which the move must be chosen"""
         sensible_moves = board.availables
         if len(sensible_moves) > 0:
-            move = self.mcts.get_move(board)
+            budget = None
+            if self._time_limit is not None or deadline is not None:
+                budget = SearchBudget.timed(self._time_limit, deadline, self._min_playouts, self._max_playouts)
+            if self._use_tactics:
+                start = time.time()
+                move, _ = tactics.find_forced_move(board)
+                self.tactics_time += time.time() - start
+                if move is not None:
+                    self.n_tactical += 1
+                    self.last_search = {'playouts': 0, 'reused': 0, 'stop_reason': 'tactics',
+                                        'time': time.time() - start}
+                    self.last_stats = None
+                    return move
+            start = time.time()
+            move = self.mcts.get_move(board, budget)
+            self.search_time += time.time() - start
+            self.last_search = self.mcts.last_search
+            self.last_stats = self.mcts.move_stats
+            self.n_moves += 1
             self.mcts.update_with_move(-1)
             return move
         else:
             print("WARNING: the board is full")
 
+    def get_stats(self):
+        """moves and leaves settled by tactics, see mcts_alphaZero.MCTSPlayer"""
+        return {
+            'tactical_moves': self.n_tactical,
+            'proven_leaves': self.mcts.n_proven,
+            'tactics_time_saved': tactics_time_saved(self.n_tactical, self.tactics_time,
+                                                     self.n_moves, self.search_time),
+        }
+
     def __str__(self):
         return "MCTS {}".format(self.player)
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+import csv
+import json
+import time
+from collections import defaultdict
+
+import numpy as np
+
+
+class Metrics(object):
+    """in-process registry of training metrics, written out one row per
+    batch by log().
+
+    phase() times a part of the loop. count() adds to a counter and the
+    row reports it per second of the phase it was counted in, or of the
+    whole batch outside any phase. observe() records a latency sample,
+    timed() wraps a function to observe every call. set() keeps the
+    last value of a gauge. Every name seen once stays in later rows.
+
+    Rows are kept in history and, with a path, appended to it as JSON
+    lines, or as CSV if the path ends in .csv. A CSV file is started anew
+    by each run and rewritten when a new column appears.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.history = []
+        self.totals = defaultdict(float)  # counters over the whole run
+        self._start = self._batch_start = time.time()
+        self._phase = None
+        self._phase_time = defaultdict(float)
+        self._counts = defaultdict(float)
+        self._count_phase = {}
+        self._latencies = defaultdict(list)
+        self._gauges = {}
+        self._columns = None
+
+    def phase(self, name):
+        return _Phase(self, name)
+
+    def count(self, name, n=1):
+        self._counts[name] += n
+        self.totals[name] += n
+        if self._phase is not None:
+            self._count_phase[name] = self._phase
+
+    def observe(self, name, seconds):
+        self._latencies[name].append(seconds)
+
+    def timed(self, name, fn):
+        """fn, observing the latency of every call under name"""
+        clock = time.perf_counter
+        latencies = self._latencies
+
+        def timed(*args, **kwargs):
+            start = clock()
+            result = fn(*args, **kwargs)
+            latencies[name].append(clock() - start)
+            return result
+        return timed
+
+    def set(self, name, value):
+        self._gauges[name] = value
+
+    def row(self, step):
+        """metrics of the batch so far"""
+        now = time.time()
+        wall = now - self._batch_start
+        row = {'step': step, 'time': now, 'elapsed': now - self._start, 'batch_time': wall}
+        for name, seconds in self._phase_time.items():
+            row['phase_' + name] = seconds
+        for name, n in self._counts.items():
+            seconds = wall
+            if name in self._count_phase:
+                seconds = self._phase_time[self._count_phase[name]]
+            row[name] = n
+            row[name + '_per_sec'] = n / seconds if seconds else 0.0
+        for name, samples in self._latencies.items():
+            row[name + '_calls'] = len(samples)
+            if samples:
+                ms = np.array(samples) * 1000.0
+                p50, p90, p99 = np.percentile(ms, [50, 90, 99])
+                row.update({name + '_ms_mean': float(ms.mean()), name + '_ms_p50': float(p50),
+                            name + '_ms_p90': float(p90), name + '_ms_p99': float(p99)})
+        row.update(self._gauges)
+        return row
+
+    def log(self, step):
+        """finish the batch: record its row, write it and start the next"""
+        row = self.row(step)
+        self.history.append(row)
+        if self.path is not None:
+            self._write(row)
+        self._batch_start = time.time()
+        for values in (self._phase_time, self._counts):
+            for name in values:
+                values[name] = 0.0
+        for name in self._latencies:
+            self._latencies[name] = []
+        return row
+
+    def _write(self, row):
+        if not self.path.endswith('.csv'):
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(row) + '\n')
+            return
+        if self._columns is not None and set(row) <= set(self._columns):
+            with open(self.path, 'a') as f:
+                csv.DictWriter(f, self._columns, restval='').writerow(row)
+            return
+        # a new column, write the file again under the wider header
+        columns = list(self._columns or [])
+        for past in self.history:
+            columns.extend(name for name in past if name not in columns)
+        self._columns = columns
+        with open(self.path, 'w') as f:
+            writer = csv.DictWriter(f, columns, restval='')
+            writer.writeheader()
+            writer.writerows(self.history)
+
+
+class _Phase(object):
+
+    def __init__(self, metrics, name):
+        self._metrics = metrics
+        self._name = name
+
+    def __enter__(self):
+        self._outer = self._metrics._phase
+        self._metrics._phase = self._name
+        self._start = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        self._metrics._phase_time[self._name] += time.time() - self._start
+        self._metrics._phase = self._outer
+        return False
@@ -1,18 +1,35 @@
 # -*- coding: utf-8 -*-
 from __future__ import print_function
-from game import GUI_interface
+import threading
+from game import GUI_interface, Board, ArrayBoard
 from mcts_alphaZero import MCTSPlayer
-from policy import PolicyValueNet
+from policy import inference_net
+from eval_cache import EvalCache
 from config import Conf
 
 
 def run():
     policy_param = Conf.model_file
-    best_policy = PolicyValueNet(policy_param)
-    mcts_player = MCTSPlayer(best_policy.policy_value_fn,
+    # the network is built, importing TensorFlow, in the background so the
+    # board shows up at once, the first AI move waits for it if needed
+    best_policy = inference_net(policy_param)
+    threading.Thread(target=best_policy.preload, daemon=True).start()
+    policy_fn = best_policy.policy_value_fn
+    if Conf.eval_cache_size > 0:
+        policy_fn = EvalCache(policy_fn, Conf.eval_cache_size)
+    mcts_player = MCTSPlayer(policy_fn,
                              c_puct=Conf.n_in_row,
-                             n_playout=Conf.n_playout)  # set larger n_playout for better performance
-    g = GUI_interface(Conf.board_width, Conf.board_height, Conf.n_in_row, mcts_player)
+                             n_playout=Conf.n_playout,
+                             array_tree=Conf.array_tree,
+                             batch_size=Conf.leaf_batch_size,
+                             batch_policy_fn=best_policy.policy_value_batch_fn,
+                             use_tactics=Conf.use_tactics,
+                             reuse_tree=Conf.reuse_tree,
+                             time_limit=Conf.move_time)  # set larger n_playout for better performance
+    board_class = ArrayBoard if Conf.compact_board else Board
+    g = GUI_interface(Conf.board_width, Conf.board_height, Conf.n_in_row, mcts_player,
+                      board_class=board_class, ponder=Conf.ponder, n_history=Conf.n_history,
+                      candidate_distance=Conf.candidate_distance)
     g.run()
 
 
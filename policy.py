@@ -1,32 +1,62 @@
 from __future__ import print_function
 
-from keras.engine.topology import Input
-from keras.engine.training import Model
-from keras.layers.convolutional import Conv2D
-from keras.layers.core import Dense, Flatten
-from keras.regularizers import l2
-from keras.optimizers import Adam
-import keras.backend as K
-import numpy as np
+import hashlib
+import json
+import os
 import pickle
+import sys
+import threading
+import numpy as np
 from config import Conf
 
+# Keras, and with it TensorFlow, is imported when the first network is built
+
 
 class PolicyValueNet():
 
-    def __init__(self, model_file=None):
+    def __init__(self, model_file=None, inference_only=False):
+        """with inference_only no optimizer is compiled, so train_step is
+        missing, and the network is only built, importing Keras, when
+        preload() or the first evaluation needs it"""
         self.board_width = Conf.board_width
         self.board_height = Conf.board_height
         self.l2_const = Conf.l2_const  # coef of l2 penalty
-        self.create_policy_value_net()
-        self._loss_train_op()
-
+        self.n_planes = 2 * Conf.n_history + 2  # see Board.current_state
+        self.model = None
+        self._net_params = None
         if model_file:
-            net_params = pickle.load(open(model_file, 'rb'))
-            self.model.set_weights(net_params)
+            self._net_params = load_params(model_file)
+            check_params(self._net_params, self.n_planes, self.board_width, self.board_height)
+        self._lock = threading.Lock()
+        if inference_only:
+            self.policy_value = self._lazy_policy_value
+        else:
+            self.preload()
+            self._loss_train_op()
+
+    def preload(self):
+        """build the network now, safe to call from any thread"""
+        with self._lock:
+            if self.model is None:
+                self.create_policy_value_net()
+                if self._net_params is not None:
+                    self.model.set_weights(self._net_params)
+                    self._net_params = None
+
+    def _lazy_policy_value(self, state_input):
+        self.preload()
+        # create_policy_value_net has replaced self.policy_value
+        return self.policy_value(state_input)
 
     def create_policy_value_net(self):
-        in_x = network = Input((4, self.board_width, self.board_height))
+        from keras.engine.topology import Input
+        from keras.engine.training import Model
+        from keras.layers.convolutional import Conv2D
+        from keras.layers.core import Dense, Flatten
+        from keras.regularizers import l2
+        import keras.backend as K
+
+        in_x = network = Input((self.n_planes, self.board_width, self.board_height))
         network = Conv2D(filters=32, kernel_size=(3, 3), padding="same", data_format="channels_first",
                          activation="relu", kernel_regularizer=l2(self.l2_const))(network)
         network = Conv2D(filters=64, kernel_size=(3, 3), padding="same", data_format="channels_first",
@@ -43,27 +73,47 @@ class PolicyValueNet():
         value_net = Flatten()(value_net)
         value_net = Dense(64, kernel_regularizer=l2(self.l2_const))(value_net)
         self.value_net = Dense(1, activation="tanh", kernel_regularizer=l2(self.l2_const))(value_net)
-        self.model = Model(in_x, [self.policy_net, self.value_net])
+        model = Model(in_x, [self.policy_net, self.value_net])
+        # predict may be called from other threads, e.g. the InferenceServer's,
+        # which have no default TensorFlow graph of their own
+        model._make_predict_function()
+        graph = K.get_session().graph if K.backend() == 'tensorflow' else None
 
         def policy_value(state_input):
             state_input_union = np.array(state_input)
-            results = self.model.predict_on_batch(state_input_union)
-            return results
+            if graph is None:
+                return model.predict_on_batch(state_input_union)
+            with graph.as_default():
+                return model.predict_on_batch(state_input_union)
 
         self.policy_value = policy_value
+        self.model = model
 
     def policy_value_fn(self, board):
-        legal_positions = board.availables
+        legal_positions = board.sensible_moves()
         current_state = board.current_state()
-        act_probs, value = self.policy_value(current_state.reshape(-1, 4, self.board_width, self.board_height))
+        act_probs, value = self.policy_value(current_state.reshape(-1, self.n_planes, self.board_width, self.board_height))
         act_probs = zip(legal_positions, act_probs.flatten()[legal_positions])
         return act_probs, value[0][0]
 
+    def policy_value_batch_fn(self, states, legal_positions):
+        """evaluate several positions in one network call.
+        states: list or array of current_state planes, legal_positions: list of the
+        legal moves of each position. Returns one (act_probs, value) pair
+        per position, as policy_value_fn does.
+        """
+        act_probs, value = self.policy_value(np.asarray(states))
+        return [(zip(legal, probs[legal]), v[0])
+                for legal, probs, v in zip(legal_positions, act_probs, value)]
+
     def _loss_train_op(self):
         """
         Three loss terms：
         loss = (z - v)^2 + pi^T * log(p) + c||theta||^2
         """
+        from keras.optimizers import Adam
+        import keras.backend as K
+
         opt = Adam()
         losses = ['categorical_crossentropy', 'mean_squared_error']
         self.model.compile(optimizer=opt, loss=losses)
@@ -86,9 +136,111 @@ class PolicyValueNet():
         self.train_step = train_step
 
     def get_policy_param(self):
-        net_params = self.model.get_weights()
+        with self._lock:
+            if self.model is None:
+                return self._net_params
+            net_params = self.model.get_weights()
         return net_params
 
+    def set_policy_param(self, net_params):
+        with self._lock:
+            if self.model is None:
+                self._net_params = net_params
+                return
+        self.model.set_weights(net_params)
+
     def save_model(self, model_file):
-        net_params = self.get_policy_param()
-        pickle.dump(net_params, open(model_file, 'wb'), protocol=2)
+        save_params(self.get_policy_param(), model_file)
+
+
+def inference_net(model_file=None):
+    """a network for evaluation only, PolicyValueNet or the NumPy one
+    as Conf.inference_backend says"""
+    if Conf.inference_backend == 'numpy':
+        from policy_numpy import NumpyPolicyValueNet
+        net = NumpyPolicyValueNet(model_file, Conf.inference_precision)
+        if model_file and net.precision != 'float32' and net.memory_saved() <= 0:
+            print("WARNING: %s weights take no less memory than float32 for %s, use float32" %
+                  (net.precision, model_file))
+        return net
+    if Conf.inference_precision != 'float32':
+        raise ValueError("inference_precision %r needs inference_backend 'numpy'" % Conf.inference_precision)
+    return PolicyValueNet(model_file, inference_only=True)
+
+
+def check_params(net_params, n_planes, width, height):
+    """raise ValueError unless net_params fit a network for this board"""
+    conv1, policy_dense = np.shape(net_params[0]), np.shape(net_params[12])
+    expected = ((3, 3, n_planes, 32), (4 * width * height, width * height))
+    if (conv1, policy_dense) != expected:
+        raise ValueError('the weights have input %s and policy %s, a %dx%d board with %d planes needs %s and %s' %
+                         ((conv1, policy_dense, width, height, n_planes) + expected))
+
+
+def _raw_paths(model_file):
+    """(manifest, raw weights) file names next to model_file"""
+    root = os.path.splitext(model_file)[0]
+    return root + '.json', root + '.weights'
+
+
+def save_params(net_params, model_file):
+    """write weights from get_policy_param() in the format PolicyValueNet
+    loads: a pickle at model_file, and next to it a raw float32 file and
+    a JSON manifest of the array shapes that load_params maps into memory"""
+    pickle.dump(net_params, open(model_file, 'wb'), protocol=2)
+    save_raw_params(net_params, model_file)
+
+
+def _checksum(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def save_raw_params(net_params, model_file):
+    manifest_file, raw_file = _raw_paths(model_file)
+    arrays = [np.asarray(arr, dtype=np.float32) for arr in net_params]
+    manifest = {'format': 'gobang-weights', 'version': 1, 'dtype': 'float32',
+                'raw_file': os.path.basename(raw_file), 'arrays': []}
+    if os.path.exists(model_file):
+        # the pickle these weights were written from, see load_params
+        manifest['source_sha1'] = _checksum(model_file)
+    offset = 0
+    for arr in arrays:
+        manifest['arrays'].append({'shape': list(arr.shape), 'offset': offset})
+        offset += arr.nbytes
+    # replaced whole so a reader never maps a half written file, the
+    # manifest last so it never names a raw file not yet written
+    with open(raw_file + '.tmp', 'wb') as f:
+        for arr in arrays:
+            f.write(arr.tobytes())
+    os.replace(raw_file + '.tmp', raw_file)
+    with open(manifest_file + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(manifest_file + '.tmp', manifest_file)
+
+
+def load_params(model_file):
+    """weights saved by save_params. They are mapped read-only from the
+    raw file when its manifest was written from this very model_file,
+    going by its checksum, model_file may also name the manifest itself,
+    otherwise unpickled"""
+    manifest_file, _ = _raw_paths(model_file)
+    manifest = None
+    if os.path.exists(manifest_file):
+        with open(manifest_file) as f:
+            manifest = json.load(f)
+    if model_file != manifest_file and (
+            manifest is None or manifest.get('source_sha1') != _checksum(model_file)):
+        return pickle.load(open(model_file, 'rb'))
+    raw = np.memmap(os.path.join(os.path.dirname(manifest_file), manifest['raw_file']),
+                    dtype=manifest['dtype'], mode='r')
+    itemsize = raw.dtype.itemsize
+    return [raw[entry['offset'] // itemsize:][:int(np.prod(entry['shape']))].reshape(entry['shape'])
+            for entry in manifest['arrays']]
+
+
+if __name__ == '__main__':
+    # write the raw weights of existing pickled models, e.g. best_policy_8.model
+    for model_file in sys.argv[1:]:
+        save_raw_params(pickle.load(open(model_file, 'rb')), model_file)
+        print('{} -> {}'.format(model_file, ', '.join(_raw_paths(model_file))))
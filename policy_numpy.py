@@ -0,0 +1,281 @@
+# -*- coding: utf-8 -*-
+"""PolicyValueNet forward pass in NumPy, for playing without Keras.
+
+    python policy_numpy.py [model_file] [--games 4]
+
+compares it with the Keras network on random positions when Keras is
+installed, reports how far the int8 weights move the policy (KL
+divergence) and value (squared error) from float32 on the positions of
+a few self-play games, and prints the weights' memory and the latency
+at batch 1 and 64 of both.
+"""
+from __future__ import print_function
+import argparse
+import threading
+import time
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+from config import Conf
+from policy import check_params, load_params
+
+PRECISIONS = ('float32', 'int8')
+WIDEN_SIZE = 32768  # int8 weights widened to float32 at a time
+
+
+def _quantize(w, precision):
+    """(weights, per output channel scales or None) of a float32 matrix
+    with the output channels as columns"""
+    if precision == 'int8':
+        scale = np.abs(w).max(axis=0) / 127.0
+        scale[scale == 0] = 1.0
+        return np.round(w / scale).astype(np.int8), scale.astype(np.float32)
+    return w, None
+
+
+class NumpyPolicyValueNet(object):
+    """the network of policy.PolicyValueNet evaluated with NumPy, a drop-in
+    for its inference methods.
+
+    Activations are kept channels-last. A 3x3 convolution copies the 3x3
+    windows of its zero padded input, taken with stride tricks, into one
+    matrix and multiplies it by the kernel (im2col), so each layer is a
+    single matmul. The dense layers after the channels-first Flatten of
+    Keras get their rows reordered once when the weights are set. All
+    intermediate arrays are allocated for the largest batch seen so far
+    and reused.
+
+    float32 is the default and the fastest. precision 'int8' is for memory
+    only: it keeps the weights as int8 with one scale per output channel,
+    about a quarter of the memory, but NumPy only multiplies float32 fast,
+    so a layer is multiplied a few output channels at a time, each block
+    widened into a float32 buffer of WIDEN_SIZE values on every call, and
+    the scales are applied to the layer's output. That makes it slower
+    than float32, so keep float32 for self-play and training.
+    """
+
+    def __init__(self, model_file=None, precision='float32'):
+        if precision not in PRECISIONS:
+            raise ValueError('precision must be one of {}, not {!r}'.format(PRECISIONS, precision))
+        self.board_width = Conf.board_width
+        self.board_height = Conf.board_height
+        self.n_planes = 2 * Conf.n_history + 2  # see Board.current_state
+        self.precision = precision
+        self._net_params = None
+        self._capacity = 0
+        self._lock = threading.Lock()
+        if model_file:
+            self.set_policy_param(load_params(model_file))
+
+    def preload(self):
+        """nothing to build, for the PolicyValueNet interface"""
+
+    def get_policy_param(self):
+        return self._net_params
+
+    def set_policy_param(self, net_params):
+        """weights in the order of PolicyValueNet.get_policy_param()"""
+        check_params(net_params, self.n_planes, self.board_width, self.board_height)
+        size = self.board_width * self.board_height
+        layers = [(np.asarray(w, dtype=np.float32), np.asarray(b, dtype=np.float32))
+                  for w, b in zip(net_params[0::2], net_params[1::2])]
+        # tell the layers apart by their shapes, not their position in the list
+        convs = {}
+        dense = {}
+        for w, b in layers:
+            if w.ndim == 4:
+                convs[w.shape[3]] = (w.reshape(-1, w.shape[3]), b)
+            else:
+                dense[w.shape] = (w, b)
+        ordered = [convs[32], convs[64], convs[128], convs[4], convs[2],
+                   self._channels_last(dense[(4 * size, size)], 4),
+                   self._channels_last(dense[(2 * size, 64)], 2),
+                   dense[(64, 1)]]
+        ordered = [_quantize(w, self.precision) + (b,) for w, b in ordered]
+        with self._lock:
+            self._convs = ordered[:3]
+            (self._policy_conv, self._value_conv, self._policy_dense,
+             self._value_dense1, self._value_dense2) = ordered[3:]
+            self._scratch = None
+            if self.precision != 'float32':
+                self._scratch = np.empty(WIDEN_SIZE, dtype=np.float32)
+            self._net_params = net_params
+
+    def _channels_last(self, layer, channels):
+        """reorder the rows of a dense layer that follows Flatten of a
+        (channels, height, width) map to take the same map as (height,
+        width, channels)"""
+        w, b = layer
+        w = w.reshape(channels, self.board_width, self.board_height, -1).transpose(1, 2, 0, 3)
+        return np.ascontiguousarray(w.reshape(-1, w.shape[-1])), b
+
+    def nbytes(self):
+        """(bytes of the weights as kept, bytes of the float32 buffer they
+        are widened into)"""
+        layers = self._convs + [self._policy_conv, self._value_conv, self._policy_dense,
+                                self._value_dense1, self._value_dense2]
+        total = sum(w.nbytes + b.nbytes + (0 if scale is None else scale.nbytes)
+                    for w, scale, b in layers)
+        return total, 0 if self._scratch is None else self._scratch.nbytes
+
+    def memory_saved(self):
+        """bytes saved over float32 weights, the widening buffer counted,
+        negative if the precision costs memory"""
+        float32_bytes = 4 * sum(np.size(param) for param in self._net_params)
+        return float32_bytes - sum(self.nbytes())
+
+    def _allocate(self, n):
+        h, w = self.board_width, self.board_height
+        channels = [self.n_planes, 32, 64]
+        # zero padded inputs of the 3x3 convolutions, only the inside is written
+        self._padded = [np.zeros((n, h + 2, w + 2, c), dtype=np.float32) for c in channels]
+        self._cols = [np.empty((n * h * w, 9 * c), dtype=np.float32) for c in channels]
+        self._conv_out = [np.empty((n * h * w, c), dtype=np.float32) for c in (32, 64, 128)]
+        self._policy_map = np.empty((n * h * w, 4), dtype=np.float32)
+        self._value_map = np.empty((n * h * w, 2), dtype=np.float32)
+        self._capacity = n
+
+    def _dense(self, x, layer, out, relu=False):
+        """out = x times the layer's weights plus its bias"""
+        w, scale, bias = layer
+        if w.dtype == np.float32:
+            np.matmul(x, w, out=out)
+        else:
+            step = max(len(self._scratch) // len(w), 1)
+            for start in range(0, w.shape[1], step):
+                block = w[:, start:start + step]
+                wide = self._scratch[:block.size].reshape(block.shape)
+                np.copyto(wide, block)
+                np.matmul(x, wide, out=out[:, start:start + step])
+        if scale is not None:
+            out *= scale
+        out += bias
+        if relu:
+            np.maximum(out, 0, out=out)
+        return out
+
+    def _conv3x3(self, i, n):
+        """im2col convolution of layer i for the first n positions"""
+        h, w = self.board_width, self.board_height
+        padded = self._padded[i][:n]
+        c = padded.shape[3]
+        s0, s1, s2, s3 = padded.strides
+        windows = as_strided(padded, shape=(n, h, w, 3, 3, c), strides=(s0, s1, s2, s1, s2, s3))
+        cols = self._cols[i][:n * h * w]
+        np.copyto(cols.reshape(n, h, w, 3, 3, c), windows)
+        return self._dense(cols, self._convs[i], self._conv_out[i][:n * h * w], relu=True)
+
+    def policy_value(self, state_input):
+        """(act_probs, value) for a batch of current_state planes, as
+        PolicyValueNet.policy_value returns them"""
+        states = np.asarray(state_input)
+        n = len(states)
+        h, w = self.board_width, self.board_height
+        with self._lock:
+            if n > self._capacity:
+                self._allocate(n)
+            self._padded[0][:n, 1:-1, 1:-1] = states.transpose(0, 2, 3, 1)
+            out = None
+            for i in range(3):
+                out = self._conv3x3(i, n)
+                if i < 2:
+                    self._padded[i + 1][:n, 1:-1, 1:-1] = out.reshape(n, h, w, -1)
+            policy = self._dense(out, self._policy_conv, self._policy_map[:len(out)], relu=True)
+            logits = self._dense(policy.reshape(n, -1), self._policy_dense,
+                                 np.empty((n, h * w), dtype=np.float32))
+            value = self._dense(out, self._value_conv, self._value_map[:len(out)], relu=True)
+            hidden = self._dense(value.reshape(n, -1), self._value_dense1, np.empty((n, 64), dtype=np.float32))
+            value = self._dense(hidden, self._value_dense2, np.empty((n, 1), dtype=np.float32))
+        logits -= logits.max(axis=1, keepdims=True)
+        act_probs = np.exp(logits)
+        act_probs /= act_probs.sum(axis=1, keepdims=True)
+        return act_probs, np.tanh(value, out=value)
+
+    def policy_value_fn(self, board):
+        """see PolicyValueNet.policy_value_fn"""
+        legal_positions = board.sensible_moves()
+        planes = np.empty((1, self.n_planes, board.height, board.width), dtype=np.float32)
+        board.write_state(planes[0])
+        act_probs, value = self.policy_value(planes)
+        return zip(legal_positions, act_probs[0][legal_positions]), value[0][0]
+
+    def policy_value_batch_fn(self, states, legal_positions):
+        """see PolicyValueNet.policy_value_batch_fn"""
+        act_probs, value = self.policy_value(np.asarray(states))
+        return [(zip(legal, probs[legal]), v[0])
+                for legal, probs, v in zip(legal_positions, act_probs, value)]
+
+
+def accuracy_report(reference, net, states):
+    """how far net is from reference on states: mean and max KL divergence
+    of the policies, value mean squared error and how often both put the
+    highest probability on the same move"""
+    probs, value = reference.policy_value(states)
+    other_probs, other_value = net.policy_value(states)
+    kl = np.sum(probs * (np.log(probs + 1e-10) - np.log(other_probs + 1e-10)), axis=1)
+    return {
+        'policy_kl_mean': float(kl.mean()),
+        'policy_kl_max': float(kl.max()),
+        'value_mse': float(np.mean((value - other_value) ** 2)),
+        'top1_agreement': float(np.mean(probs.argmax(axis=1) == other_probs.argmax(axis=1))),
+    }
+
+
+def selfplay_positions(net, n_games, n_playout=100):
+    """uint8 planes of every position of n_games self-play games of net"""
+    from game import ArrayBoard, Game
+    from mcts_alphaZero import MCTSPlayer
+
+    board = ArrayBoard(width=net.board_width, height=net.board_height,
+                       n_in_row=Conf.n_in_row, n_history=Conf.n_history)
+    game = Game(board)
+    player = MCTSPlayer(net.policy_value_fn, c_puct=Conf.c_puct, n_playout=n_playout, is_selfplay=1)
+    states = []
+    for _ in range(n_games):
+        _, play_data = game.start_self_play(player, temp=Conf.temp)
+        states.extend(state for state, _, _ in play_data)
+    return np.array(states, dtype=np.uint8)
+
+
+def _latency(policy_value, states, n_calls):
+    policy_value(states)
+    start = time.perf_counter()
+    for _ in range(n_calls):
+        policy_value(states)
+    return (time.perf_counter() - start) / n_calls * 1000.0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='check and time the NumPy network')
+    parser.add_argument('model_file', nargs='?', default=Conf.model_file)
+    parser.add_argument('--games', type=int, default=4, help='self-play games for the accuracy report')
+    args = parser.parse_args(argv)
+    np.random.seed(0)
+    # a square board of the size the weights were trained for
+    Conf.board_width = Conf.board_height = int(round(np.sqrt(np.shape(load_params(args.model_file)[12])[1])))
+    nets = [(precision, NumpyPolicyValueNet(args.model_file, precision)) for precision in PRECISIONS]
+    net = nets[0][1]
+    states = (np.random.rand(64, net.n_planes, net.board_width, net.board_height) > 0.7).astype(np.uint8)
+    try:
+        from policy import PolicyValueNet
+        keras_net = PolicyValueNet(args.model_file, inference_only=True)
+        keras_net.preload()
+        report = accuracy_report(keras_net, net, states)
+        print('float32 vs keras: policy kl {policy_kl_max:.2e} (max), value mse {value_mse:.2e}'.format(**report))
+        nets.append(('keras', keras_net))
+    except ImportError as e:
+        print('keras not available ({}), not compared'.format(e))
+    held_out = selfplay_positions(net, args.games)
+    print('{} positions from {} self-play games'.format(len(held_out), args.games))
+    for name, impl in nets:
+        line = '{:>8}: batch 1 {:.3f} ms, batch 64 {:.3f} ms'.format(
+            name, _latency(impl.policy_value, states[:1], 500), _latency(impl.policy_value, states, 20))
+        if name in PRECISIONS:
+            line += ', weights {:.0f} KB + {:.0f} KB buffer'.format(*(n / 1024.0 for n in impl.nbytes()))
+        if name == 'int8':
+            line += ', policy kl {policy_kl_mean:.2e} (max {policy_kl_max:.2e}), value mse {value_mse:.2e}, ' \
+                    'same best move {top1_agreement:.1%}'.format(**accuracy_report(net, impl, held_out))
+        print(line)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+import os
+
+import numpy as np
+
+_MAGIC = 0x47425242  # 'GBRB'
+_VERSION = 1
+# magic, version, n_planes, height, width, capacity, cursor, count
+_HEADER_FIELDS = 8
+_HEADER_BYTES = 64
+
+
+class ReplayBuffer(object):
+    """fixed size ring buffer of self-play positions in preallocated arrays.
+
+    The binary input planes of each position are bit-packed into uint8,
+    policy targets are stored as float16 and outcomes as int8. Once full,
+    new positions overwrite the oldest ones. sample() gathers a minibatch
+    into float32 arrays that are reused between calls.
+
+    With a path the arrays are memory-mapped from that file instead, after
+    a small header holding the board size, write cursor and count, so the
+    buffer survives restarts and reopening it reads nothing up front. An
+    existing file is reopened if its board size matches. readonly=True
+    maps it read-only, any number of such readers can share the file of
+    one writer and see its new positions on every sample().
+    """
+
+    def __init__(self, capacity, n_planes, height, width, path=None, readonly=False):
+        self.capacity = capacity
+        self.state_shape = (n_planes, height, width)
+        self.path = path
+        self.readonly = readonly
+        self._n_bits = n_planes * height * width
+        self._batch_size = 0
+        state_bytes = (self._n_bits + 7) // 8
+        if path is None:
+            self._header = np.zeros(_HEADER_FIELDS, dtype=np.int64)
+            self._states = np.zeros((capacity, state_bytes), dtype=np.uint8)
+            self._probs = np.zeros((capacity, height * width), dtype=np.float16)
+            self._winners = np.zeros(capacity, dtype=np.int8)
+            return
+        if not readonly and not os.path.exists(path):
+            # a sparse file of the full size, pages are allocated as they are written
+            with open(path, 'wb') as f:
+                f.truncate(_HEADER_BYTES + capacity * (state_bytes + 2 * height * width + 1))
+            header = np.memmap(path, dtype=np.int64, mode='r+', shape=(_HEADER_FIELDS,))
+            header[:6] = [_MAGIC, _VERSION, n_planes, height, width, capacity]
+            header.flush()
+        mode = 'r' if readonly else 'r+'
+        self._header = np.memmap(path, dtype=np.int64, mode=mode, shape=(_HEADER_FIELDS,))
+        expected = [_MAGIC, _VERSION, n_planes, height, width]
+        if self._header[:5].tolist() != expected:
+            raise ValueError('%s holds a buffer for %s, expected %s' %
+                             (path, self._header[:5].tolist(), expected))
+        # the file decides the capacity so readers need not know it
+        self.capacity = capacity = int(self._header[5])
+        offset = _HEADER_BYTES
+        self._states = np.memmap(path, dtype=np.uint8, mode=mode, offset=offset,
+                                 shape=(capacity, state_bytes))
+        offset += self._states.nbytes
+        self._probs = np.memmap(path, dtype=np.float16, mode=mode, offset=offset,
+                                shape=(capacity, height * width))
+        offset += self._probs.nbytes
+        self._winners = np.memmap(path, dtype=np.int8, mode=mode, offset=offset,
+                                  shape=(capacity,))
+
+    @property
+    def _cursor(self):
+        """next slot to write"""
+        return int(self._header[6])
+
+    @property
+    def _count(self):
+        return int(self._header[7])
+
+    def __len__(self):
+        return self._count
+
+    @property
+    def write_mark(self):
+        """changes whenever positions are added, e.g. by another process"""
+        return self._count, self._cursor
+
+    def extend(self, play_data):
+        """append (state, mcts_probs, winner_z) tuples"""
+        play_data = list(play_data)
+        if not play_data:
+            return
+        states, probs, winners = zip(*play_data)
+        states = np.asarray(states).reshape(len(states), self._n_bits) > 0.5
+        idx = (self._cursor + np.arange(len(play_data))) % self.capacity
+        self._states[idx] = np.packbits(states, axis=1)
+        self._probs[idx] = probs
+        self._winners[idx] = winners
+        # the header is written last, readers never see unwritten slots
+        self._header[7] = min(self._count + len(play_data), self.capacity)
+        self._header[6] = (self._cursor + len(play_data)) % self.capacity
+
+    def flush(self):
+        """write the mapped pages to disk, a no-op for in-memory buffers"""
+        if self.path is not None and not self.readonly:
+            for arr in (self._states, self._probs, self._winners, self._header):
+                arr.flush()
+
+    def _batch_arrays(self, batch_size):
+        if batch_size != self._batch_size:
+            self._state_batch = np.empty((batch_size,) + self.state_shape, dtype=np.float32)
+            self._probs_batch = np.empty((batch_size, self._probs.shape[1]), dtype=np.float32)
+            self._winner_batch = np.empty(batch_size, dtype=np.float32)
+            self._batch_size = batch_size
+        return self._state_batch, self._probs_batch, self._winner_batch
+
+    def sample(self, batch_size):
+        """return (states, mcts_probs, winners) for batch_size distinct
+        random positions. The arrays are overwritten by the next call."""
+        idx = np.random.choice(self._count, batch_size, replace=False)
+        state_batch, probs_batch, winner_batch = self._batch_arrays(batch_size)
+        bits = np.unpackbits(self._states[idx], axis=1, count=self._n_bits)
+        np.copyto(state_batch, bits.reshape(state_batch.shape))
+        np.copyto(probs_batch, self._probs[idx])
+        np.copyto(winner_batch, self._winners[idx])
+        return state_batch, probs_batch, winner_batch
+
+    def nbytes(self):
+        return self._states.nbytes + self._probs.nbytes + self._winners.nbytes
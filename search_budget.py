@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+import time
+
+import numpy as np
+
+
+class SearchBudget(object):
+    """decides when a search stops.
+
+    Without a deadline the search runs max_playouts playouts, as a fixed
+    n_playout search does. With a deadline (time.time() seconds) it runs
+    at least min_playouts, and always one, and at most max_playouts
+    playouts, stops at the deadline, and stops early once the most visited
+    root child is ahead of the second by more than the playouts that still
+    fit in the time left. stop_reason() names why: 'playouts', 'time' or 'decided'.
+    """
+
+    def __init__(self, max_playouts=None, deadline=None, min_playouts=0, check_every=16):
+        if max_playouts is None and deadline is None:
+            raise ValueError('a search budget needs max_playouts or a deadline')
+        self.max_playouts = max_playouts
+        self.deadline = deadline
+        self.min_playouts = min_playouts
+        self._check_every = check_every
+
+    @classmethod
+    def timed(cls, time_limit=None, deadline=None, min_playouts=0, max_playouts=None):
+        """budget for a move that must be played within time_limit seconds
+        or by deadline, whichever is earlier"""
+        if time_limit is not None:
+            end = time.time() + time_limit
+            deadline = end if deadline is None else min(deadline, end)
+        return cls(max_playouts, deadline, min_playouts)
+
+    def start(self, n_done=0):
+        """n_done: visits the root already has, e.g. from a reused tree"""
+        self._start_time = time.time()
+        self._start_done = n_done
+        self._next_check = n_done + self._check_every
+
+    def stop_reason(self, n_done, root_visits):
+        """None while the search should go on. root_visits returns the
+        (actions, visits) of the root's children"""
+        if self.max_playouts is not None and n_done >= self.max_playouts:
+            return 'playouts'
+        # one playout even past the deadline, so the root has a move to pick
+        if self.deadline is None or n_done < max(self.min_playouts, 1):
+            return None
+        now = time.time()
+        if now >= self.deadline:
+            return 'time'
+        if n_done < self._next_check:
+            return None
+        self._next_check = n_done + self._check_every
+        act_visits = list(root_visits())
+        if not act_visits or len(act_visits[1]) == 0:
+            return None
+        visits = np.asarray(act_visits[1])
+        if len(visits) == 1:
+            return 'decided'
+        second, best = np.partition(visits, len(visits) - 2)[-2:]
+        rate = (n_done - self._start_done) / max(now - self._start_time, 1e-9)
+        remaining = rate * (self.deadline - now)
+        if self.max_playouts is not None:
+            remaining = min(remaining, self.max_playouts - n_done)
+        if best - second > remaining:
+            return 'decided'
+        return None
+
+    def elapsed(self):
+        return time.time() - self._start_time
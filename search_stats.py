@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+"""optional timing of the MCTS search phases.
+
+enable_stats() wraps the phase methods of one search object in timers,
+stored as instance attributes that shadow the class methods, so a search
+without stats runs exactly the code it runs without this module and
+disable_stats() takes the timers away again.
+"""
+import json
+import os
+import time
+
+
+class SearchStats(object):
+    """time and calls per search phase, playouts, tree size and maximum
+    depth of one search, or of several searches added together"""
+
+    def __init__(self):
+        self.time = {}
+        self.calls = {}
+        self.searches = 0
+        self.playouts = 0
+        self.elapsed = 0.0
+        self.tree_size = 0
+        self.max_depth = 0  # moves from the root to the deepest leaf
+
+    def count(self, phase, seconds):
+        self.time[phase] = self.time.get(phase, 0.0) + seconds
+        self.calls[phase] = self.calls.get(phase, 0) + 1
+
+    def reset(self):
+        self.__init__()
+
+    def add(self, other):
+        for phase, seconds in other.time.items():
+            self.time[phase] = self.time.get(phase, 0.0) + seconds
+            self.calls[phase] = self.calls.get(phase, 0) + other.calls[phase]
+        self.searches += other.searches
+        self.playouts += other.playouts
+        self.elapsed += other.elapsed
+        self.tree_size = max(self.tree_size, other.tree_size)
+        self.max_depth = max(self.max_depth, other.max_depth)
+        return self
+
+    def copy(self):
+        return SearchStats().add(self)
+
+    def nodes_per_sec(self):
+        """leaves reached per second, one per playout"""
+        return self.playouts / self.elapsed if self.elapsed else 0.0
+
+    def to_dict(self):
+        phases = {phase: {'time': self.time[phase], 'calls': self.calls[phase]}
+                  for phase in sorted(self.time)}
+        # the rest of the search: loop, budget checks and bookkeeping
+        other = self.elapsed - sum(self.time[phase] for phase in phases if phase != 'record')
+        return {
+            'searches': self.searches,
+            'playouts': self.playouts,
+            'time': self.elapsed,
+            'nodes_per_sec': self.nodes_per_sec(),
+            'tree_size': self.tree_size,
+            'max_depth': self.max_depth,
+            'phases': phases,
+            'other_time': max(other, 0.0),
+        }
+
+
+def _timed(stats, phase, fn):
+    clock = time.perf_counter
+
+    def timed(*args):
+        start = clock()
+        result = fn(*args)
+        stats.count(phase, clock() - start)
+        return result
+    timed.__wrapped__ = fn
+    return timed
+
+
+def _timed_select(stats, phase, fn):
+    """also records how many moves below the root the leaf is"""
+    clock = time.perf_counter
+
+    def timed(state):
+        n_moves = len(state.states)
+        start = clock()
+        leaf = fn(state)
+        stats.count(phase, clock() - start)
+        depth = len(state.states) - n_moves
+        if depth > stats.max_depth:
+            stats.max_depth = depth
+        return leaf
+    timed.__wrapped__ = fn
+    return timed
+
+
+class Instrumented(object):
+    """enable_stats() for a search class. Subclasses name their phase
+    methods in _stats_phases ({phase: attribute}), call _stats_start() and
+    _stats_end() around each search, and override _tree_size() unless
+    they keep their tree in TreeNodes from self._root"""
+
+    _stats_phases = {}
+    _stats = None  # SearchStats of the running search while enabled
+    move_stats = None  # SearchStats of the last search
+    stats_sink = None
+
+    def enable_stats(self, sink=None):
+        """time every search phase. After each search move_stats holds its
+        SearchStats and sink, e.g. a JsonLinesSink, is called with its
+        to_dict()"""
+        self.disable_stats()
+        self._stats = SearchStats()
+        for phase, name in self._stats_phases.items():
+            fn = getattr(self, name)
+            if fn is not None:
+                wrap = _timed_select if phase == 'select' else _timed
+                setattr(self, name, wrap(self._stats, phase, fn))
+        self.stats_sink = sink
+
+    def disable_stats(self):
+        if self._stats is None:
+            return
+        for name in self._stats_phases.values():
+            fn = getattr(self, name)
+            if fn is None:
+                continue
+            if hasattr(type(self), name):
+                delattr(self, name)
+            else:
+                setattr(self, name, fn.__wrapped__)
+        del self._stats
+        self.stats_sink = None
+
+    def _stats_start(self):
+        if self._stats is not None:
+            # drop what pondering recorded between searches
+            self._stats.reset()
+
+    def _stats_end(self, playouts, elapsed):
+        stats = self._stats
+        if stats is None:
+            return
+        stats.searches = 1
+        stats.playouts = playouts
+        stats.elapsed = elapsed
+        stats.tree_size = self._tree_size()
+        self.move_stats = stats.copy()
+        if self.stats_sink is not None:
+            self.stats_sink(dict(self.move_stats.to_dict(), event='move', search=type(self).__name__))
+
+    def _tree_size(self):
+        """nodes in the tree below self._root, a TreeNode with _children.
+        Searches keeping their tree otherwise override this"""
+        size = 0
+        nodes = [self._root]
+        while nodes:
+            node = nodes.pop()
+            size += 1
+            nodes.extend(node._children.values())
+        return size
+
+
+class JsonLinesSink(object):
+    """appends every record passed to it to path as one JSON line, with the
+    time and process id. Lines of several processes sharing the file are
+    written whole"""
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'a')
+
+    def __call__(self, record):
+        record = dict(record, timestamp=time.time(), pid=os.getpid())
+        self._file.write(json.dumps(record) + '\n')
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+import multiprocessing
+import queue
+import time
+
+
+def _load_weights(weights_queue, policy_value_net, eval_cache):
+    """apply the newest weights waiting in the queue, return False once the
+    worker has been asked to stop"""
+    weights = None
+    while True:
+        try:
+            msg = weights_queue.get_nowait()
+        except queue.Empty:
+            break
+        if msg is None:
+            return False
+        weights = msg
+    if weights is not None:
+        if policy_value_net is not None:
+            policy_value_net.set_policy_param(weights)
+        if eval_cache is not None:
+            eval_cache.clear()
+    return True
+
+
+def _worker(weights_queue, result_queue, client=None):
+    # imported here so that every process builds its own Keras session
+    from game import Board, ArrayBoard, Game
+    from mcts_alphaZero import MCTSPlayer
+    from eval_cache import EvalCache
+    from search_stats import JsonLinesSink
+    from config import Conf
+
+    board_class = ArrayBoard if Conf.compact_board else Board
+    board = board_class(width=Conf.board_width,
+                        height=Conf.board_height,
+                        n_in_row=Conf.n_in_row,
+                        n_history=Conf.n_history,
+                        candidate_distance=Conf.candidate_distance)
+    stats_sink = None
+    if Conf.search_stats_file:
+        stats_sink = JsonLinesSink(Conf.search_stats_file)
+    game = Game(board, stats_sink=stats_sink)
+    msg = weights_queue.get()
+    if msg is None:
+        return
+    if client is None:
+        from policy import inference_net
+        policy_value_net = inference_net()
+        policy_value_net.set_policy_param(msg)
+    else:
+        # positions are evaluated by the trainer's InferenceServer
+        policy_value_net = client
+    policy_fn = policy_value_net.policy_value_fn
+    eval_cache = None
+    if Conf.eval_cache_size > 0:
+        eval_cache = policy_fn = EvalCache(policy_fn, Conf.eval_cache_size)
+    mcts_player = MCTSPlayer(policy_fn, c_puct=Conf.c_puct, n_playout=Conf.n_playout,
+                             is_selfplay=1, array_tree=Conf.array_tree, batch_size=Conf.leaf_batch_size,
+                             batch_policy_fn=policy_value_net.policy_value_batch_fn,
+                             use_tactics=Conf.use_tactics)
+    if stats_sink is not None:
+        mcts_player.enable_stats(stats_sink)
+    while _load_weights(weights_queue, policy_value_net if client is None else None, eval_cache):
+        winner, play_data = game.start_self_play(mcts_player, temp=Conf.temp)
+        result_queue.put((list(play_data), mcts_player.get_stats()))
+
+
+class SelfPlayPool(object):
+    """a pool of self-play worker processes.
+
+    Each worker owns its own Board, Game, MCTSPlayer and copy of the
+    network, plays games continuously and sends every finished game back
+    over a queue. Processes are started with the 'spawn' method since
+    TensorFlow sessions are not safe to fork.
+
+    If clients (one InferenceClient per worker) are given, workers build no
+    network of their own and send their positions to the InferenceServer.
+
+    At most max_pending finished games wait to be collected, then workers
+    block until the trainer catches up, so games are not played far ahead
+    on old weights.
+    """
+
+    def __init__(self, n_workers, weights, clients=None, max_pending=None):
+        ctx = multiprocessing.get_context('spawn')
+        self._result_queue = ctx.Queue(maxsize=max_pending or n_workers)
+        self._weights_queues = [ctx.Queue() for _ in range(n_workers)]
+        clients = clients or [None] * n_workers
+        self._workers = [ctx.Process(target=_worker, args=(q, self._result_queue, client), daemon=True)
+                         for q, client in zip(self._weights_queues, clients)]
+        for worker in self._workers:
+            worker.start()
+        self.broadcast(weights)
+
+    def broadcast(self, weights):
+        """send new network weights to every worker, they are picked up
+        before the next game starts"""
+        for q in self._weights_queues:
+            q.put(weights)
+
+    def collect(self, n_games=1):
+        """block until n_games finished games have arrived, return a list of
+        (play_data, stats) with play_data as (state, mcts_probs, winner_z)"""
+        games = []
+        while len(games) < n_games:
+            try:
+                games.append(self._result_queue.get(timeout=1))
+            except queue.Empty:
+                if not any(worker.is_alive() for worker in self._workers):
+                    raise RuntimeError('all self-play workers have exited')
+        return games
+
+    def close(self, timeout=10):
+        for q in self._weights_queues:
+            q.put(None)
+        deadline = time.time() + timeout
+        for worker in self._workers:
+            while worker.is_alive() and time.time() < deadline:
+                # unblock workers waiting to hand in a game
+                try:
+                    while True:
+                        self._result_queue.get_nowait()
+                except queue.Empty:
+                    pass
+                worker.join(0.1)
+            if worker.is_alive():
+                worker.terminate()
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+"""forced moves found without search: immediate wins, blocks of the
+opponent's fours and victories by continuous fours (VCF).
+
+Threats are read from the stone planes of Board.current_state() with one
+table of all n-in-a-row windows, so every check is a few NumPy
+operations on any Board class.
+"""
+import numpy as np
+from game import _windows
+
+
+def _stones(board, player):
+    """(own, opponent) stones of player as flat arrays indexed by move"""
+    state = board.current_state()
+    # current_state flips the rows, undo that to index by move
+    own = state[0, ::-1].ravel()
+    opponent = state[1, ::-1].ravel()
+    if player is not None and player != board.get_current_player():
+        own, opponent = opponent, own
+    return own, opponent
+
+
+def _threats(board, player, n_missing):
+    """empty points of the windows where player misses n_missing stones and
+    the opponent has none, and how many such windows each one is in"""
+    cells = _windows(board.width, board.height, board.n_in_row)
+    own, opponent = _stones(board, player)
+    # an opponent stone pushes the window sum past n_in_row
+    weights = own + (board.n_in_row + 1) * opponent
+    rows = cells[weights[cells].sum(axis=1) == board.n_in_row - n_missing]
+    return np.unique(rows[own[rows] == 0], return_counts=True)
+
+
+def winning_moves(board, player=None):
+    """moves that complete n in a row for player, the player to move by
+    default"""
+    moves, _ = _threats(board, player, 1)
+    return moves.tolist()
+
+
+def four_moves(board, player=None):
+    """moves after which player threatens to win, most threats first"""
+    moves, counts = _threats(board, player, 2)
+    return moves[np.argsort(-counts, kind='stable')].tolist()
+
+
+def _opponent(board, player):
+    p1, p2 = board.players
+    return p1 if player == p2 else p2
+
+
+def vcf(board, max_depth=10, max_nodes=2000):
+    """a winning line of fours for the player to move, starting with the
+    move to play and alternating with the forced replies, or None if none
+    is found within max_depth own moves and max_nodes positions"""
+    n_moves = len(board.states)
+    try:
+        return _vcf(board, max_depth, [max_nodes])
+    finally:
+        board.undo_to(n_moves)
+
+
+def _vcf(board, depth, budget):
+    wins = winning_moves(board)
+    if wins:
+        return [wins[0]]
+    if depth == 0 or budget[0] <= 0:
+        return None
+    budget[0] -= 1
+    attacker = board.get_current_player()
+    moves = four_moves(board)
+    threats = winning_moves(board, _opponent(board, attacker))
+    if threats:
+        # only a four that also blocks the opponent's four keeps the attack
+        if len(threats) > 1:
+            return None
+        moves = [move for move in moves if move == threats[0]]
+    for move in moves:
+        line = None
+        board.do_move(move)
+        if not winning_moves(board):
+            replies = winning_moves(board, attacker)
+            if len(replies) > 1:
+                line = [move]
+            else:
+                board.do_move(replies[0])
+                rest = _vcf(board, depth - 1, budget)
+                board.undo_move()
+                if rest is not None:
+                    line = [move, replies[0]] + rest
+        board.undo_move()
+        if line is not None:
+            return line
+    return None
+
+
+def find_forced_move(board, max_depth=10, max_nodes=2000):
+    """return (move, reason) with reason 'win', 'block' or 'vcf' when the
+    player to move has a forced move, (None, None) otherwise"""
+    wins = winning_moves(board)
+    if wins:
+        return wins[0], 'win'
+    threats = winning_moves(board, _opponent(board, board.get_current_player()))
+    if threats:
+        return threats[0], 'block'
+    if max_depth > 0:
+        line = vcf(board, max_depth, max_nodes)
+        if line is not None:
+            return line[0], 'vcf'
+    return None, None
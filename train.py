@@ -1,65 +1,106 @@
 from __future__ import print_function
-import random
+import multiprocessing
+import time
 import numpy as np
-from collections import defaultdict
-from game import Board, Game
+from game import Board, ArrayBoard, Game
 from mcts_pure import MCTSPlayer as MCTS_Pure
 from mcts_alphaZero import MCTSPlayer
-from policy import PolicyValueNet
+from policy import PolicyValueNet, inference_net, save_params
+from selfplay import SelfPlayPool
+from evaluation import Evaluator, win_ratio
+from inference_server import InferenceServer
+from eval_cache import EvalCache
+from augment import get_equi_data, random_symmetry
+from search_stats import JsonLinesSink
+from metrics import Metrics
+from replay_buffer import ReplayBuffer
 from config import Conf
 
-board = Board(width=Conf.board_width,
-              height=Conf.board_height,
-              n_in_row=Conf.n_in_row)
-game = Game(board)
+board_class = ArrayBoard if Conf.compact_board else Board
+board = board_class(width=Conf.board_width,
+                    height=Conf.board_height,
+                    n_in_row=Conf.n_in_row,
+                    n_history=Conf.n_history,
+                    candidate_distance=Conf.candidate_distance)
+stats_sink = None
+if Conf.search_stats_file and multiprocessing.current_process().name == 'MainProcess':
+    stats_sink = JsonLinesSink(Conf.search_stats_file)
+game = Game(board, stats_sink=stats_sink)
 
-if Conf.init_model:
-    policy_value_net = PolicyValueNet(Conf.init_model)
-else:
-    policy_value_net = PolicyValueNet()
-mcts_player = MCTSPlayer(policy_value_net.policy_value_fn, c_puct=Conf.c_puct, n_playout=Conf.n_playout, is_selfplay=1)
-
-
-def get_equi_data(play_data):
-    extend_data = []
-    for state, mcts_porb, winner in play_data:
-        for i in [1, 2, 3, 4]:
-            equi_state = np.array([np.rot90(s, i) for s in state])
-            equi_mcts_prob = np.rot90(np.flipud(mcts_porb.reshape(Conf.board_height, Conf.board_width)), i)
-            extend_data.append((equi_state, np.flipud(equi_mcts_prob).flatten(), winner))
-            equi_state = np.array([np.fliplr(s) for s in equi_state])
-            equi_mcts_prob = np.fliplr(equi_mcts_prob)
-            extend_data.append((equi_state, np.flipud(equi_mcts_prob).flatten(), winner))
-    return extend_data
+metrics = Metrics(Conf.metrics_file)
+eval_cache = None
+# spawned self-play processes re-import this module, only the trainer
+# process itself needs a network
+if multiprocessing.current_process().name == 'MainProcess':
+    if Conf.init_model:
+        policy_value_net = PolicyValueNet(Conf.init_model)
+    else:
+        policy_value_net = PolicyValueNet()
+    search_net = policy_value_net
+    if Conf.inference_backend != 'keras':
+        # self-play and evaluation search with a copy updated after every training step
+        search_net = inference_net()
+        search_net.set_policy_param(policy_value_net.get_policy_param())
+    # network calls made in this process, cache hits are not counted
+    policy_fn = metrics.timed('inference', search_net.policy_value_fn)
+    batch_policy_fn = metrics.timed('inference', search_net.policy_value_batch_fn)
+    if Conf.eval_cache_size > 0:
+        eval_cache = policy_fn = EvalCache(policy_fn, Conf.eval_cache_size)
+    mcts_player = MCTSPlayer(policy_fn, c_puct=Conf.c_puct, n_playout=Conf.n_playout,
+                             is_selfplay=1, array_tree=Conf.array_tree, batch_size=Conf.leaf_batch_size,
+                             batch_policy_fn=batch_policy_fn,
+                             use_tactics=Conf.use_tactics)
+    if stats_sink is not None:
+        mcts_player.enable_stats(stats_sink)
+selfplay_pool = None
+inference_server = None
+evaluator = None
 
 
 def collect_selfplay_data(n_games=1):
-    for i in range(n_games):
-        winner, play_data = game.start_self_play(mcts_player, temp=Conf.temp)
-        play_data = list(play_data)[:]
+    """play n_games, in the worker pool if there is one, and return the
+    search stats of the last game, None without games"""
+    stats = None
+    with metrics.phase('selfplay'):
+        if selfplay_pool is not None:
+            games = selfplay_pool.collect(n_games)
+        else:
+            games = []
+            for i in range(n_games):
+                winner, play_data = game.start_self_play(mcts_player, temp=Conf.temp)
+                games.append((list(play_data), mcts_player.get_stats()))
+        metrics.count('games', len(games))
+        metrics.count('positions', sum(len(play_data) for play_data, _ in games))
+    for play_data, stats in games:
         Conf.episode_len = len(play_data)
-        # augment the data
-        play_data = get_equi_data(play_data)
+        if Conf.augment == 'eager':
+            # store all 8 symmetries, otherwise policy_update picks one per sample
+            with metrics.phase('augment'):
+                play_data = get_equi_data(play_data)
         Conf.data_buffer.extend(play_data)
+    return stats
 
 
 def policy_update():
-    mini_batch = random.sample(Conf.data_buffer, Conf.batch_size)
-    state_batch = [data[0] for data in mini_batch]
-    mcts_probs_batch = [data[1] for data in mini_batch]
-    winner_batch = [data[2] for data in mini_batch]
-    old_probs, old_v = policy_value_net.policy_value(state_batch)
-    for i in range(Conf.epochs):
-        loss, entropy = policy_value_net.train_step(
-            state_batch,
-            mcts_probs_batch,
-            winner_batch,
-            Conf.learn_rate * Conf.lr_multiplier)
-        new_probs, new_v = policy_value_net.policy_value(state_batch)
-        kl = np.mean(np.sum(old_probs * (np.log(old_probs + 1e-10) - np.log(new_probs + 1e-10)), axis=1)
-                     )
-        if kl > Conf.kl_targ * 4:  # early stopping if D_KL diverges badly
-            break
+    with metrics.phase('sample'):
+        state_batch, mcts_probs_batch, winner_batch = Conf.data_buffer.sample(Conf.batch_size)
+    if Conf.augment == 'lazy':
+        with metrics.phase('augment'):
+            state_batch, mcts_probs_batch = random_symmetry(state_batch, mcts_probs_batch)
+    with metrics.phase('train'):
+        old_probs, old_v = policy_value_net.policy_value(state_batch)
+        for i in range(Conf.epochs):
+            loss, entropy = policy_value_net.train_step(
+                state_batch,
+                mcts_probs_batch,
+                winner_batch,
+                Conf.learn_rate * Conf.lr_multiplier)
+            metrics.count('train_samples', len(state_batch))
+            new_probs, new_v = policy_value_net.policy_value(state_batch)
+            kl = np.mean(np.sum(old_probs * (np.log(old_probs + 1e-10) - np.log(new_probs + 1e-10)), axis=1)
+                         )
+            if kl > Conf.kl_targ * 4:  # early stopping if D_KL diverges badly
+                break
     if kl > Conf.kl_targ * 2 and Conf.lr_multiplier > 0.1:
         Conf.lr_multiplier /= 1.5
     elif kl < Conf.kl_targ / 2 and Conf.lr_multiplier < 10:
@@ -79,54 +120,169 @@ def policy_update():
                     entropy,
                     explained_var_old,
                     explained_var_new))
+    for name, value in (('kl', kl), ('lr_multiplier', Conf.lr_multiplier), ('loss', loss), ('entropy', entropy),
+                        ('explained_var_old', explained_var_old), ('explained_var_new', explained_var_new)):
+        metrics.set(name, float(value))
+    if search_net is not policy_value_net:
+        search_net.set_policy_param(policy_value_net.get_policy_param())
     return loss, entropy
 
 
 def policy_evaluate(n_games=10):
-    current_mcts_player = MCTSPlayer(policy_value_net.policy_value_fn,
+    """play n_games against pure MCTS, return (win_ratio, win_cnt)"""
+    if evaluator is not None:
+        evaluator.submit(policy_value_net.get_policy_param(), n_games, Conf.pure_mcts_playout_num)
+        return evaluator.result()[:2]
+    # a fresh tree every move, so each move gets n_playout new playouts
+    # and win ratios stay comparable with earlier checkpoints
+    current_mcts_player = MCTSPlayer(policy_fn,
                                      c_puct=Conf.c_puct,
-                                     n_playout=Conf.n_playout)
+                                     n_playout=Conf.n_playout,
+                                     array_tree=Conf.array_tree,
+                                     batch_size=Conf.leaf_batch_size,
+                                     batch_policy_fn=batch_policy_fn,
+                                     use_tactics=Conf.use_tactics)
     pure_mcts_player = MCTS_Pure(c_puct=5,
-                                 n_playout=Conf.pure_mcts_playout_num)
-    win_cnt = defaultdict(int)
+                                 n_playout=Conf.pure_mcts_playout_num,
+                                 array_tree=Conf.array_tree,
+                                 use_tactics=Conf.use_tactics)
+    winners = []
     for i in range(n_games):
-        winner = game.start_play(current_mcts_player,
-                                 pure_mcts_player,
-                                 start_player=i % 2,
-                                 is_shown=0)
-        win_cnt[winner] += 1
-    win_ratio = 1.0 * (win_cnt[1] + 0.5 * win_cnt[-1]) / n_games
+        winners.append(game.start_play(current_mcts_player,
+                                       pure_mcts_player,
+                                       start_player=i % 2,
+                                       is_shown=0))
+    return win_ratio(winners)
+
+
+def promote(ratio, win_cnt, net_params, pure_mcts_playout_num):
+    """save net_params as the best policy if they beat the previous best"""
     print("num_playouts:{}, win: {}, lose: {}, tie:{}".format(
-        Conf.pure_mcts_playout_num,
+        pure_mcts_playout_num,
         win_cnt[1], win_cnt[2], win_cnt[-1]))
-    return win_ratio
+    metrics.set('win_ratio', ratio)
+    metrics.set('pure_mcts_playout_num', pure_mcts_playout_num)
+    if ratio > Conf.best_win_ratio:
+        print("New best policy!!!!!!!!")
+        Conf.best_win_ratio = ratio
+        # update the best_policy
+        save_params(net_params, './best_policy_' + str(Conf.board_width) + '.model')
+        if (Conf.best_win_ratio == 1.0 and
+                Conf.pure_mcts_playout_num < 5000):
+            Conf.pure_mcts_playout_num += 1000
+            Conf.best_win_ratio = 0.0
+
+
+def log_metrics(step):
+    """write the metrics row of batch step"""
+    metrics.set('buffer_size', len(Conf.data_buffer))
+    metrics.set('buffer_fill', 1.0 * len(Conf.data_buffer) / Conf.data_buffer.capacity)
+    if inference_server is not None:
+        # latency of the self-play workers' requests, queueing included
+        stats = inference_server.stats()
+        metrics.set('server_batches', stats['batches'])
+        metrics.set('server_mean_batch_size', stats['mean_batch_size'])
+        for name, value in stats.get('queue_latency_ms', {}).items():
+            metrics.set('server_latency_ms_' + name, value)
+    if eval_cache is not None:
+        metrics.set('eval_cache_hit_rate', eval_cache.stats()['hit_rate'])
+    return metrics.log(step)
+
+
+def open_buffer():
+    """open Conf.data_buffer, here rather than in config so that the
+    spawned worker processes do not map the buffer file too"""
+    if Conf.data_buffer is None:
+        Conf.data_buffer = ReplayBuffer(Conf.buffer_size, 2 * Conf.n_history + 2, Conf.board_height,
+                                        Conf.board_width, Conf.buffer_path, Conf.buffer_readonly)
+    return Conf.data_buffer
+
+
+def wait_for_positions(mark, poll_interval=1.0):
+    """block until the shared buffer holds more than a batch and another
+    run has added positions since write_mark was mark"""
+    while len(Conf.data_buffer) <= Conf.batch_size or Conf.data_buffer.write_mark == mark:
+        time.sleep(poll_interval)
 
 
 def run():
+    global selfplay_pool, inference_server, evaluator
+    open_buffer()
+    mark = None
+    if Conf.n_eval_workers > 0 or Conf.eval_async:
+        evaluator = Evaluator(max(Conf.n_eval_workers, 1))
+    if Conf.n_selfplay_workers > 0:
+        clients = None
+        if Conf.inference_server:
+            inference_server = InferenceServer(search_net.policy_value,
+                                               Conf.inference_max_batch_size,
+                                               Conf.inference_max_wait)
+            clients = [inference_server.client() for _ in range(Conf.n_selfplay_workers)]
+            inference_server.start()
+        selfplay_pool = SelfPlayPool(Conf.n_selfplay_workers, policy_value_net.get_policy_param(), clients,
+                                     max_pending=Conf.n_selfplay_workers * Conf.play_batch_size)
     try:
         for i in range(Conf.game_batch_num):
-            collect_selfplay_data(Conf.play_batch_size)
-            print("batch i:{}, episode_len:{}".format(
-                i + 1, Conf.episode_len))
+            if Conf.data_buffer.readonly:
+                # another run fills the shared buffer, only train on it
+                wait_for_positions(mark)
+                mark = Conf.data_buffer.write_mark
+                print("batch i:{}, buffer size:{}".format(i + 1, len(Conf.data_buffer)))
+            else:
+                start = time.time()
+                stats = collect_selfplay_data(Conf.play_batch_size)
+                games_per_hour = 3600.0 * Conf.play_batch_size / (time.time() - start)
+                print("batch i:{}, episode_len:{}, games/hour:{:.1f}, nn_batch_size:{:.1f}, moves/sec:{:.2f}".format(
+                    i + 1, Conf.episode_len, games_per_hour, stats['nn_batch_size'], stats['moves_per_sec']))
             if len(Conf.data_buffer) > Conf.batch_size:
-                loss, entropy = policy_update()
+                if inference_server is not None:
+                    # keep the server from evaluating while the weights change
+                    with inference_server.lock:
+                        loss, entropy = policy_update()
+                else:
+                    loss, entropy = policy_update()
+                if eval_cache is not None:
+                    eval_cache.clear()
+                if selfplay_pool is not None:
+                    # workers also drop their cached evaluations
+                    selfplay_pool.broadcast(policy_value_net.get_policy_param())
             # check the performance of the current model,
             # and save the model params
             if (i + 1) % Conf.check_freq == 0:
                 print("current self-play batch: {}".format(i + 1))
-                win_ratio = policy_evaluate()
+                if inference_server is not None:
+                    print("inference server: {}".format(inference_server.stats()))
+                if eval_cache is not None:
+                    print("eval cache: {}".format(eval_cache.stats()))
                 policy_value_net.save_model('./current_policy_' + str(Conf.board_width) + '.model')
-                if win_ratio > Conf.best_win_ratio:
-                    print("New best policy!!!!!!!!")
-                    best_win_ratio = win_ratio
-                    # update the best_policy
-                    policy_value_net.save_model('./best_policy_' + str(Conf.board_width) + '.model')
-                    if (best_win_ratio == 1.0 and
-                            Conf.pure_mcts_playout_num < 5000):
-                        Conf.pure_mcts_playout_num += 1000
-                        Conf.best_win_ratio = 0.0
+                if not Conf.eval_async:
+                    with metrics.phase('evaluate'):
+                        ratio, win_cnt = policy_evaluate(Conf.n_eval_games)
+                    promote(ratio, win_cnt, policy_value_net.get_policy_param(), Conf.pure_mcts_playout_num)
+                elif evaluator.busy():
+                    print("previous evaluation still running, skipping this checkpoint")
+                else:
+                    # play against a snapshot while training goes on
+                    evaluator.submit(policy_value_net.get_policy_param(), Conf.n_eval_games,
+                                     Conf.pure_mcts_playout_num)
+            if Conf.eval_async:
+                result = evaluator.result(timeout=0)
+                if result is not None:
+                    promote(*result)
+            log_metrics(i + 1)
     except KeyboardInterrupt:
         print('\n\rquit')
+        if Conf.data_buffer.path is not None:
+            # resume with Conf.init_model set to this file
+            policy_value_net.save_model('./current_policy_' + str(Conf.board_width) + '.model')
+    finally:
+        Conf.data_buffer.flush()
+        if selfplay_pool is not None:
+            selfplay_pool.close()
+        if inference_server is not None:
+            inference_server.stop()
+        if evaluator is not None:
+            evaluator.close()
 
 
 if __name__ == '__main__':